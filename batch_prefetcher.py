@@ -0,0 +1,168 @@
+"""Background minibatch assembly for training.
+
+A worker thread draws batches from a DataSet (gathering the phi's and
+converting them to the data set's batch dtype) and keeps a bounded
+queue of them filled, so that the agent only has to hand a ready batch
+to the network while the next ones are being built.
+"""
+
+import Queue
+import threading
+
+
+class BatchPrefetcher(object):
+    """ Keeps up to num_batches batches from a DataSet ready.
+    """
+
+    def __init__(self, data_set, batch_size, num_batches,
+                 priority_beta=None, n_step=1):
+        """ Construct a BatchPrefetcher.  Call start() to begin
+        filling the queue.
+
+        Arguments:
+            data_set - the DataSet to draw from.
+            batch_size - number of transitions per batch.
+            num_batches - maximum number of batches waiting in the queue.
+            priority_beta - if given, batches come from
+                            data_set.prioritized_batch with this
+                            importance-sampling exponent.
+            n_step - number of steps spanned by uniformly drawn
+                     transitions.
+        """
+        self.data_set = data_set
+        self.batch_size = batch_size
+        self.priority_beta = priority_beta
+        self.n_step = n_step
+        self.queue = Queue.Queue(maxsize=num_batches)
+
+        # One set of buffers for every batch in the queue, plus the one
+        # being filled and the one the consumer is training on.
+        self._buffers = [data_set._empty_batch(batch_size, n_step)
+                         for _ in range(num_batches + 2)]
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def get(self):
+        """ Return the next batch, in the format of random_batch (or
+        prioritized_batch.)  It stays valid until the next call.
+        """
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def _run(self):
+        count = 0
+        while not self._stopped.is_set():
+            out = self._buffers[count % len(self._buffers)]
+            try:
+                if self.priority_beta is None:
+                    batch = self.data_set.random_batch(self.batch_size, out,
+                                                       self.n_step)
+                else:
+                    batch = self.data_set.prioritized_batch(
+                        self.batch_size, self.priority_beta, out)
+            except Exception as e:
+                # Hand the error to the consumer instead of dying
+                # silently.
+                batch = e
+            while not self._stopped.is_set():
+                try:
+                    self.queue.put(batch, timeout=.1)
+                    break
+                except Queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
+            count += 1
+
+
+# TESTING CODE BELOW THIS POINT...
+
+def _filled_data_set(num_samples=200):
+    import numpy as np
+    import sumo_data_set
+    dataset = sumo_data_set.DataSet(width=3, height=4, max_steps=100,
+                                    phi_length=4, capacity=107)
+    for i in range(num_samples):
+        img = np.random.randint(0, 256, size=(4, 3))
+        dataset.add_sample(img, i, i, np.random.random() < .05)
+    return dataset
+
+
+def test_matches_random_batch():
+    import time
+    import numpy as np
+    dataset = _filled_data_set()
+    num_batches = 3
+
+    np.random.seed(5)
+    expected = [[np.array(array) for array in dataset.random_batch(10)]
+                for _ in range(4 * num_batches)]
+
+    np.random.seed(5)
+    prefetcher = BatchPrefetcher(dataset, 10, num_batches)
+    prefetcher.start()
+    try:
+        for arrays in expected:
+            batch = prefetcher.get()
+            # Give the worker time to fill the queue and the spare
+            # buffer; the batch must not be overwritten before the
+            # next call to get.
+            time.sleep(.05)
+            for array, expected_array in zip(batch, arrays):
+                np.testing.assert_array_equal(array, expected_array)
+    finally:
+        prefetcher.stop()
+    print "passed"
+
+
+def test_worker_error():
+    import sumo_data_set
+    # Too few samples to draw a batch from.
+    dataset = sumo_data_set.DataSet(width=3, height=4, max_steps=100,
+                                    phi_length=4)
+    prefetcher = BatchPrefetcher(dataset, 10, 2)
+    prefetcher.start()
+    try:
+        prefetcher.get()
+    except ValueError:
+        pass
+    else:
+        assert False, "the worker's error was not raised"
+    prefetcher.stop()
+    assert not prefetcher._thread.is_alive()
+    print "passed"
+
+
+def test_stop():
+    import time
+    prefetcher = BatchPrefetcher(_filled_data_set(), 10, 2)
+    prefetcher.start()
+    prefetcher.get()
+    # Let the worker block on the full queue.
+    time.sleep(.1)
+    assert prefetcher.queue.full()
+    start = time.time()
+    prefetcher.stop()
+    assert not prefetcher._thread.is_alive()
+    assert time.time() - start < 1
+    print "passed"
+
+
+def main():
+    test_matches_random_batch()
+    test_worker_error()
+    test_stop()
+
+
+if __name__ == '__main__':
+    main()
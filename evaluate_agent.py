@@ -97,17 +97,13 @@ class AgentEvaluation(object):
 	def load_network(self):
 		"""
 		Takes the first argument from the command line. This should be a network
-		pickle file. The function will unpickle it and return the network.
+		file (.npz, or a pickled .pkl). The function will load it and return
+		the network, without the target network it only needs for training.
 		"""
 		if self.nn_file == None:
 			return 0
 		else:
-			nn_file = self.nn_file
-			handle = open(nn_file, 'r')
-			network = cPickle.load(handle)
-			handle.close()
-
-			return network
+			return q_network.load_network(self.nn_file, freeze_interval=0)
 
 	def _load_layers(self):
 		self.q_layers = lasagne.layers.get_all_layers(self.network.l_out)
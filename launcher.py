@@ -42,7 +42,19 @@ def launch_rlglue_agent(parameters, agent_type='neural'):
                                               parameters.batch_size,
                                               parameters.replay_start_size,
                                               parameters.update_frequency,
-                                              parameters.image_resize)
+                                              parameters.image_resize,
+                                              parameters.replay_storage,
+                                              parameters.replay_path,
+                                              parameters.priority_alpha,
+                                              parameters.priority_beta,
+                                              parameters.prefetch_batches,
+                                              parameters.uint8_batches,
+                                              parameters.replay_file,
+                                              parameters.save_replay,
+                                              parameters.n_step,
+                                              parameters.device_replay,
+                                              parameters.graph_cache,
+                                              parameters.target_tau)
     elif agent_type == '1D':
         import rl_glue_sumo_agent_1D
         agent = rl_glue_sumo_agent_1D.NeuralAgent(parameters.discount,
@@ -65,7 +77,19 @@ def launch_rlglue_agent(parameters, agent_type='neural'):
                                               parameters.batch_size,
                                               parameters.replay_start_size,
                                               parameters.update_frequency,
-                                              parameters.image_resize)
+                                              parameters.image_resize,
+                                              parameters.replay_storage,
+                                              parameters.replay_path,
+                                              parameters.priority_alpha,
+                                              parameters.priority_beta,
+                                              parameters.prefetch_batches,
+                                              parameters.uint8_batches,
+                                              parameters.replay_file,
+                                              parameters.save_replay,
+                                              parameters.n_step,
+                                              parameters.device_replay,
+                                              parameters.graph_cache,
+                                              parameters.target_tau)
     elif agent_type == 'fixed':
         import rl_glue_sumo_agent_fixed_timing
         agent = rl_glue_sumo_agent_fixed_timing.FixedTimeAgent(parameters.experiment_prefix, 20)
@@ -179,8 +203,9 @@ def process_args(args, defaults, description):
                         help='Batch size. (default: %(default)s)')
     parser.add_argument('--network-type', dest="network_type",
                         type=str, default=defaults.NETWORK_TYPE,
-                        help=('nips_cuda|nips_dnn|nature_cuda|nature_dnn' +
-                              '|linear (default: %(default)s)'))
+                        help=('nips_cuda|nips_dnn|nips_cpu|nature_cuda|' +
+                              'nature_dnn|nature_cpu|1D_dnn|1D_cpu|linear ' +
+                              '(default: %(default)s)'))
     parser.add_argument('--freeze-interval', dest="freeze_interval",
                         type=int, default=defaults.FREEZE_INTERVAL,
                         help=('Interval between target freezes. ' +
@@ -196,8 +221,66 @@ def process_args(args, defaults, description):
     parser.add_argument('--image-resize', dest="image_resize",
                         type=str, default=defaults.IMAGE_RESIZE,
                         help=('crop|scale (default: %(default)s)'))
+    parser.add_argument('--replay-storage', dest="replay_storage",
+                        type=str, default=defaults.REPLAY_STORAGE,
+                        help=('Replay frame storage, packed and sparse ' +
+                              'only work for binary frames. ' +
+                              'dense|packed|sparse (default: %(default)s)'))
+    parser.add_argument('--replay-path', dest="replay_path",
+                        type=str, default=defaults.REPLAY_PATH,
+                        help=('Directory for a memory-mapped replay memory. ' +
+                              'An existing replay memory there is reopened. ' +
+                              '(default: in RAM)'))
+    parser.add_argument('--priority-alpha', dest="priority_alpha",
+                        type=float, default=defaults.PRIORITY_ALPHA,
+                        help=('Prioritized replay exponent, 0 samples ' +
+                              'uniformly. (default: %(default)s)'))
+    parser.add_argument('--priority-beta', dest="priority_beta",
+                        type=float, default=defaults.PRIORITY_BETA,
+                        help=('Importance-sampling exponent for prioritized ' +
+                              'replay. (default: %(default)s)'))
+    parser.add_argument('--prefetch-batches', dest="prefetch_batches",
+                        type=int, default=defaults.PREFETCH_BATCHES,
+                        help=('Number of minibatches to prepare on a ' +
+                              'background thread, 0 to disable. ' +
+                              '(default: %(default)s)'))
+    parser.add_argument('--uint8-batches', dest="uint8_batches",
+                        action='store_true', default=defaults.UINT8_BATCHES,
+                        help=('Keep minibatches as uint8 images and scale ' +
+                              'them inside the network.'))
+    parser.add_argument('--replay-file', dest="replay_file",
+                        type=str, default=defaults.REPLAY_FILE,
+                        help=('Replay memory snapshot to start from, ' +
+                              'written by --save-replay. ' +
+                              '(default: %(default)s)'))
+    parser.add_argument('--save-replay', dest="save_replay",
+                        action='store_true', default=defaults.SAVE_REPLAY,
+                        help=('Save a snapshot of the replay memory ' +
+                              'after every epoch.'))
+    parser.add_argument('--n-step', dest="n_step",
+                        type=int, default=defaults.N_STEP,
+                        help=('Number of steps spanned by the rewards of ' +
+                              'each training transition. Only with uniform ' +
+                              'replay. (default: %(default)s)'))
+    parser.add_argument('--device-replay', dest="device_replay",
+                        action='store_true', default=defaults.DEVICE_REPLAY,
+                        help=('Keep a copy of the replay frames in the ' +
+                              'network and send only sample indices per ' +
+                              'update. Only with uniform replay.'))
+    parser.add_argument('--graph-cache', dest="graph_cache", type=str,
+                        default=defaults.GRAPH_CACHE,
+                        help=('Directory to cache compiled networks in, ' +
+                              'to skip compilation on later starts. ' +
+                              '(default: %(default)s)'))
+    parser.add_argument('--target-tau', dest="target_tau", type=float,
+                        default=defaults.TARGET_TAU,
+                        help=('If > 0, move the target network towards ' +
+                              'the trained one by this fraction after ' +
+                              'every update instead of copying it every ' +
+                              'freeze interval. (default: %(default)s)'))
     parser.add_argument('--nn-file', dest="nn_file", type=str, default=None,
-                        help='Pickle file containing trained net.')
+                        help=('Network file (.npz, or a pickled .pkl) ' +
+                              'to start from.'))
     parser.add_argument('--pause', type=float, default=0,
                         help='Amount of time to pause display while testing.')
 
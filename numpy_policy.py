@@ -0,0 +1,281 @@
+"""Evaluate an exported network with NumPy alone.
+
+DeepQLearner.export_policy writes the layers of a trained network to an
+.npz file.  NumpyPolicy loads it and computes q values without theano or
+lasagne, so a controller that only needs choose_action starts in
+milliseconds.  Convolutions copy im2col views of their (padded) input
+into a column buffer and multiply it with the filters in one BLAS call.
+Activations are kept as batch x height x width x channels, so that no
+layer has to transpose them, and all buffers are allocated once for
+every batch size used.
+
+Usage:
+
+    q_network.load_network('network_file_10.npz').export_policy('policy.npz')
+    policy = NumpyPolicy('policy.npz')
+    action = policy.choose_action(phi, epsilon)
+"""
+
+import json
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+class NumpyPolicy(object):
+    """ An exported DeepQLearner, with its q_vals, batch_q_vals and
+    choose_action.
+    """
+
+    def __init__(self, filename):
+        archive = np.load(filename)
+        config = json.loads(str(archive['config']))
+        self.num_actions = config['num_actions']
+        self.input_shape = tuple(config['input_shape'])
+        self._specs = config['layers']
+        self._params = [dict((name, archive['{}_{}'.format(name, i)])
+                             for name in ('W', 'b')
+                             if '{}_{}'.format(name, i) in archive.files)
+                        for i in range(len(self._specs))]
+        self._channels_last = self._specs[0]['type'] != 'dense'
+        self._prepare_params(1.0 / config['input_scale'])
+        self._pipelines = {}
+
+    def _prepare_params(self, input_scale):
+        """
+        Bring the parameters into the layout the layers compute with,
+        and fold the input scaling into the first weights.  Scaling
+        commutes with padding, max-pooling and rectification, so it can
+        be applied to the first layer that has weights.
+        """
+        shape = (self.input_shape[1], self.input_shape[2],
+                 self.input_shape[0])
+        channels_last = self._channels_last
+        for spec, params in zip(self._specs, self._params):
+            if 'W' in params:
+                params['W'] = params['W'].astype('float32')
+                if input_scale != 1:
+                    params['W'] *= input_scale
+                    input_scale = 1
+            if 'b' in params:
+                params['b'] = params['b'].astype('float32')
+
+            if spec['type'] == 'conv':
+                filters = params['W']
+                # Rows in the order of the values of an image patch.
+                params['W'] = np.ascontiguousarray(
+                    filters.transpose(2, 3, 1, 0).reshape(
+                        -1, filters.shape[0]))
+                shape = _conv_shape(shape, spec['filter_size'],
+                                    spec['stride'], spec['pad'],
+                                    filters.shape[0])
+            elif spec['type'] == 'maxpool':
+                shape = _conv_shape(shape, spec['pool_size'],
+                                    spec['stride'], [(0, 0), (0, 0)],
+                                    shape[2])
+            elif spec['type'] == 'dense':
+                weights = params['W']
+                if channels_last and len(shape) == 3:
+                    # lasagne flattens channels x height x width.
+                    height, width, channels = shape
+                    weights = weights.reshape(
+                        (channels, height, width, -1)).transpose(
+                            1, 2, 0, 3).reshape((-1, weights.shape[1]))
+                params['W'] = np.ascontiguousarray(weights)
+                shape = (weights.shape[1],)
+            channels_last = True
+
+    def _pipeline(self, batch_size):
+        """ Return the input buffer, layers and output buffer for
+        batch_size states, building them the first time.
+        """
+        if batch_size not in self._pipelines:
+            frames, height, width = self.input_shape
+            if self._channels_last:
+                source = np.zeros((batch_size, height, width, frames),
+                                  dtype='float32')
+            else:
+                source = np.zeros((batch_size, frames, height, width),
+                                  dtype='float32')
+            inputs = source
+            layers = []
+            for spec, params in zip(self._specs, self._params):
+                layer = _LAYERS[spec['type']](spec, params, source)
+                layers.append(layer)
+                source = layer.out
+            self._pipelines[batch_size] = (inputs, layers, source)
+        return self._pipelines[batch_size]
+
+    def _forward(self, states):
+        inputs, layers, outputs = self._pipeline(len(states))
+        if self._channels_last:
+            inputs[...] = np.asarray(states).transpose(0, 2, 3, 1)
+        else:
+            inputs[...] = states
+        for layer in layers:
+            layer.forward()
+        return outputs
+
+    def q_vals(self, state):
+        return self._forward(state[np.newaxis])[0].copy()
+
+    def batch_q_vals(self, states, chunk_size=32):
+        """
+        Return the q values of every state in states, an array of shape
+        (n, num_frames, height, width), as an (n, num_actions) array.
+        """
+        q_vals = np.empty((len(states), self.num_actions), dtype='float32')
+        for start in range(0, len(states), chunk_size):
+            chunk = states[start:start + chunk_size]
+            q_vals[start:start + len(chunk)] = self._forward(chunk)
+        return q_vals
+
+    def choose_action(self, state, epsilon):
+        if np.random.rand() < epsilon:
+            return np.random.randint(0, self.num_actions)
+        q_vals = self.q_vals(state)
+        return np.argmax(q_vals)
+
+
+def _conv_shape(shape, sizes, stride, pad, channels):
+    """ Return the height x width x channels output shape of a
+    convolution or pooling of a height x width input.
+    """
+    height, width = shape[0], shape[1]
+    return ((height + sum(pad[0]) - sizes[0]) // stride[0] + 1,
+            (width + sum(pad[1]) - sizes[1]) // stride[1] + 1,
+            channels)
+
+
+def _patches(images, sizes, stride):
+    """ Return a batch x rows x columns x size x size x channels view
+    of the image patches a convolution or pooling reads.
+    """
+    batch, height, width, channels = images.shape
+    rows = (height - sizes[0]) // stride[0] + 1
+    columns = (width - sizes[1]) // stride[1] + 1
+    strides = images.strides
+    return as_strided(images,
+                      (batch, rows, columns, sizes[0], sizes[1], channels),
+                      (strides[0], strides[1] * stride[0],
+                       strides[2] * stride[1], strides[1], strides[2],
+                       strides[3]))
+
+
+def _apply_nonlinearity(name, values):
+    if name == 'rectify':
+        np.maximum(values, 0, out=values)
+    elif name == 'sigmoid':
+        np.negative(values, out=values)
+        np.exp(values, out=values)
+        values += 1
+        np.reciprocal(values, out=values)
+
+
+class _Conv(object):
+    def __init__(self, spec, params, source):
+        batch, height, width, channels = source.shape
+        (top, bottom), (left, right) = spec['pad']
+        if top or bottom or left or right:
+            padded = np.zeros((batch, height + top + bottom,
+                               width + left + right, channels),
+                              dtype='float32')
+            self.copy = (source,
+                         padded[:, top:top + height, left:left + width])
+        else:
+            padded = source
+            self.copy = None
+        self.filters = params['W']
+        self.b = params.get('b')
+        self.nonlinearity = spec['nonlinearity']
+        num_filters = self.filters.shape[1]
+        self.patches = _patches(padded, spec['filter_size'], spec['stride'])
+        self.columns = np.empty(self.patches.shape, dtype='float32')
+        self.out = np.empty(self.patches.shape[:3] + (num_filters,),
+                            dtype='float32')
+        rows = batch * self.out.shape[1] * self.out.shape[2]
+        self._columns = self.columns.reshape((rows, -1))
+        self._out = self.out.reshape((rows, num_filters))
+
+    def forward(self):
+        if self.copy is not None:
+            self.copy[1][...] = self.copy[0]
+        self.columns[...] = self.patches
+        np.dot(self._columns, self.filters, out=self._out)
+        if self.b is not None:
+            self._out += self.b
+        _apply_nonlinearity(self.nonlinearity, self._out)
+
+
+class _MaxPool(object):
+    def __init__(self, spec, params, source):
+        self.patches = _patches(source, spec['pool_size'], spec['stride'])
+        self.out = np.empty(self.patches.shape[:3] + source.shape[3:],
+                            dtype='float32')
+
+    def forward(self):
+        np.max(self.patches, axis=(3, 4), out=self.out)
+
+
+class _Dense(object):
+    def __init__(self, spec, params, source):
+        self.source = source.reshape((source.shape[0], -1))
+        self.W = params['W']
+        self.b = params.get('b')
+        self.nonlinearity = spec['nonlinearity']
+        self.out = np.empty((source.shape[0], self.W.shape[1]),
+                            dtype='float32')
+
+    def forward(self):
+        np.dot(self.source, self.W, out=self.out)
+        if self.b is not None:
+            self.out += self.b
+        _apply_nonlinearity(self.nonlinearity, self.out)
+
+
+_LAYERS = {'conv': _Conv, 'maxpool': _MaxPool, 'dense': _Dense}
+
+
+# TESTING CODE BELOW THIS POINT...
+
+def test_matches_network():
+    import os
+    import tempfile
+    import lasagne
+    import q_network
+
+    rng = np.random.RandomState(0)
+    for network_type, width, height in (('linear', 84, 84),
+                                        ('nips_cpu', 84, 84),
+                                        ('1D_cpu', 84, 8)):
+        network = q_network.DeepQLearner(width, height, 3, 4, .99, .00025,
+                                         .95, .01, 0, 0, 32, network_type,
+                                         'rmsprop', input_dtype='uint8')
+        # Random parameters, so that every weight matters.
+        for param in lasagne.layers.get_all_params(network.l_out):
+            value = param.get_value()
+            param.set_value(rng.normal(0, .1, value.shape).astype(
+                value.dtype))
+        handle, filename = tempfile.mkstemp(suffix='.npz')
+        os.close(handle)
+        try:
+            network.export_policy(filename)
+            policy = NumpyPolicy(filename)
+        finally:
+            os.remove(filename)
+
+        states = rng.randint(0, 256, (40, 4, height, width)).astype('uint8')
+        expected = network.batch_q_vals(states)
+        np.testing.assert_allclose(policy.batch_q_vals(states), expected,
+                                   rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(policy.q_vals(states[3]), expected[3],
+                                   rtol=1e-4, atol=1e-4)
+        assert policy.choose_action(states[3], 0) == np.argmax(expected[3])
+    print "passed"
+
+
+def main():
+    test_matches_network()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,19 +5,15 @@ the Deep q-network.
 
 Usage:
 
-plot_filters.py PICKLED_NN_FILE
+plot_filters.py NN_FILE
 """
 
 import sys
 import matplotlib.pyplot as plt
-import cPickle
-import lasagne.layers
+import q_network
 
-net_file = open(sys.argv[1], 'r')
-network = cPickle.load(net_file)
-print network
-q_layers = lasagne.layers.get_all_layers(network.l_out)
-w = q_layers[1].W.get_value()
+# The first parameter is the weights of the first convolution.
+w = q_network.load_params(sys.argv[1])[0]
 count = 1
 for f in range(w.shape[0]): # filters
     for c in range(w.shape[1]): # channels/time-steps
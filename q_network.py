@@ -15,6 +15,15 @@ Modifications: Nathan Sprague
 
 Modifications for SUMO by Tobias Rijken
 """
+import contextlib
+import cPickle
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
 import lasagne
 import numpy as np
 import theano
@@ -30,7 +39,30 @@ class DeepQLearner:
     def __init__(self, input_width, input_height, num_actions, num_frames,
                  discount, learning_rate, rho, rms_epsilon, momentum,
                  freeze_interval, batch_size, network_type,
-                 update_rule, batch_accumulator='mean', input_scale=255.0):
+                 update_rule, batch_accumulator='mean', input_scale=255.0,
+                 input_dtype=theano.config.floatX, replay_capacity=0,
+                 cache_dir=None, target_tau=0):
+        """
+        input_dtype is the dtype of the images passed to train and
+        q_vals.  With 'uint8' they are transferred as bytes, and cast to
+        floatX and divided by input_scale inside the compiled graph.
+
+        With replay_capacity > 0 the network keeps its own uint8 copy
+        of the replay frames in a shared variable (filled with
+        store_frames), and train_indices builds the states from sample
+        indices inside the graph instead of receiving them.
+
+        With a cache_dir, the compiled functions are pickled there after
+        they are built and unpickled, without being optimized again, by
+        later learners with the same arguments, code and theano flags.
+        startup_times lists how long each step of building took.
+
+        With target_tau > 0 the target network follows the trained one
+        by Polyak averaging, target = (1 - tau) * target + tau * params,
+        after every update instead of being copied every freeze_interval
+        updates.  freeze_interval must still be > 0 to have a target
+        network.
+        """
 
         self.input_width = input_width
         self.input_height = input_height
@@ -43,30 +75,84 @@ class DeepQLearner:
         self.rms_epsilon = rms_epsilon
         self.momentum = momentum
         self.freeze_interval = freeze_interval
+        self.input_dtype = input_dtype
+        self.replay_capacity = replay_capacity
+        self.target_tau = target_tau
+        if target_tau > 0 and freeze_interval <= 0:
+            raise ValueError("target_tau needs a target network "
+                             "(freeze_interval > 0).")
+        # Updates before which the target network is copied, if any.
+        self._sync_interval = freeze_interval if target_tau == 0 else 0
 
         self.update_counter = 0
 
+        # Everything save_weights needs to rebuild this network.
+        self.config = {'input_width': input_width,
+                       'input_height': input_height,
+                       'num_actions': num_actions,
+                       'num_frames': num_frames,
+                       'discount': discount,
+                       'learning_rate': learning_rate,
+                       'rho': rho,
+                       'rms_epsilon': rms_epsilon,
+                       'momentum': momentum,
+                       'freeze_interval': freeze_interval,
+                       'batch_size': batch_size,
+                       'network_type': network_type,
+                       'update_rule': update_rule,
+                       'batch_accumulator': batch_accumulator,
+                       'input_scale': input_scale,
+                       'input_dtype': np.dtype(input_dtype).name,
+                       'replay_capacity': replay_capacity,
+                       'target_tau': target_tau}
+
+        if cache_dir is not None:
+            cache_file = os.path.join(
+                cache_dir, 'network_{}.pkl'.format(self._cache_key()))
+            if self._load_cached(cache_file):
+                return
+
+        self.startup_times = []
+        start = time.time()
         self.l_out = self.build_network(network_type, input_width, input_height,
                                         num_actions, num_frames, batch_size)
         if self.freeze_interval > 0:
             self.next_l_out = self.build_network(network_type, input_width,
                                                  input_height, num_actions,
                                                  num_frames, batch_size)
-            self.reset_q_hat()
+        self.startup_times.append(('build layers', time.time() - start))
 
-        states = T.tensor4('states')
-        next_states = T.tensor4('next_states')
+        if self.freeze_interval > 0:
+            start = time.time()
+            # Copy the parameters into the target network on the device.
+            self._reset_q_hat = theano.function([], [], updates=zip(
+                lasagne.layers.helper.get_all_params(self.next_l_out),
+                lasagne.layers.helper.get_all_params(self.l_out)))
+            self.reset_q_hat()
+            self.startup_times.append(('compile target sync',
+                                       time.time() - start))
+
+        # Training batches arrive as one window of images per sample;
+        # states are its first num_frames images and next_states the
+        # num_frames images starting at next_offset.
+        windows = T.tensor4('windows', dtype=input_dtype)
+        next_offset = T.iscalar('next_offset')
+        # Number of steps the rewards span, discounted by gamma ** n_step.
+        n_step = T.iscalar('n_step')
+        states = windows[:, :num_frames]
+        next_states = windows[:, next_offset:next_offset + num_frames]
         rewards = T.col('rewards')
         actions = T.icol('actions')
+        weights = T.col('weights')
         #terminals = T.icol('terminals')
 
-        self.states_shared = theano.shared(
-            np.zeros((batch_size, num_frames, input_height, input_width),
-                     dtype=theano.config.floatX))
+        self.windows_shared = theano.shared(
+            np.zeros((batch_size, num_frames + 1, input_height, input_width),
+                     dtype=input_dtype))
 
-        self.next_states_shared = theano.shared(
+        self.states_shared = theano.shared(
             np.zeros((batch_size, num_frames, input_height, input_width),
-                     dtype=theano.config.floatX))
+                     dtype=input_dtype))
 
         self.rewards_shared = theano.shared(
             np.zeros((batch_size, 1), dtype=theano.config.floatX),
@@ -76,37 +162,47 @@ class DeepQLearner:
             np.zeros((batch_size, 1), dtype='int32'),
             broadcastable=(False, True))
 
+        # Importance-sampling weights for prioritized replay.
+        self.weights_shared = theano.shared(
+            np.ones((batch_size, 1), dtype=theano.config.floatX),
+            broadcastable=(False, True))
+        self._uniform_weights = True
+
         # self.terminals_shared = theano.shared(
         #     np.zeros((batch_size, 1), dtype='int32'),
         #     broadcastable=(False,True))
 
-        q_vals = lasagne.layers.get_output(self.l_out, states / input_scale)
+        def scale(images):
+            return T.cast(images, theano.config.floatX) / input_scale
+
+        q_vals = lasagne.layers.get_output(self.l_out, scale(states))
         if self.freeze_interval > 0:
             next_q_vals = lasagne.layers.get_output(self.next_l_out,
-                                                    next_states / input_scale)
+                                                    scale(next_states))
         else:
             next_q_vals = lasagne.layers.get_output(self.l_out,
-                                                    next_states / input_scale)
+                                                    scale(next_states))
             next_q_vals = theano.gradient.disconnected_grad(next_q_vals)
 
-        target = rewards + self.gamma * T.max(next_q_vals, axis=1,
-                                              keepdims=True)
+        discount = T.cast(self.gamma ** n_step, theano.config.floatX)
+        target = rewards + discount * T.max(next_q_vals, axis=1,
+                                            keepdims=True)
         diff = target - q_vals[T.arange(batch_size),
                                actions.reshape((-1,))].reshape((-1, 1))
 
         if batch_accumulator == 'sum':
-            loss = T.sum(diff ** 2)
+            loss = T.sum(weights * diff ** 2)
         elif batch_accumulator == 'mean':
-            loss = T.mean(diff ** 2)
+            loss = T.mean(weights * diff ** 2)
         else:
             raise ValueError("Bad accumulator: {}".format(batch_accumulator))
 
         params = lasagne.layers.helper.get_all_params(self.l_out)
         givens = {
-            states: self.states_shared,
-            next_states: self.next_states_shared,
+            windows: self.windows_shared,
             rewards: self.rewards_shared,
             actions: self.actions_shared,
+            weights: self.weights_shared,
             #terminals: self.terminals_shared
         }
         if update_rule == 'deepmind_rmsprop':
@@ -124,10 +220,150 @@ class DeepQLearner:
             updates = lasagne.updates.apply_momentum(updates, None,
                                                      self.momentum)
 
-        self._train = theano.function([], [loss, q_vals], updates=updates,
-                                      givens=givens)
-        self._q_vals = theano.function([], q_vals,
-                                       givens={states: self.states_shared})
+        if self.target_tau > 0:
+            tau = T.constant(target_tau, dtype=theano.config.floatX)
+            target_params = lasagne.layers.helper.get_all_params(
+                self.next_l_out)
+            for param, target in zip(params, target_params):
+                updates[target] = (1 - tau) * target + tau * updates[param]
+
+        start = time.time()
+        self._train = theano.function([next_offset, n_step],
+                                      [loss, q_vals, diff],
+                                      updates=updates, givens=givens)
+        self.startup_times.append(('compile train', time.time() - start))
+
+        # train_many compiles a scan over this graph when first called.
+        self._update_graph = ([windows, rewards, actions, weights],
+                              [next_offset, n_step], [loss, diff], updates)
+        self._train_many = None
+
+        if replay_capacity > 0:
+            start = time.time()
+            # Frame i of the replay memory is stored at position
+            # i % replay_capacity, as in DataSet.
+            self.replay_shared = theano.shared(
+                np.zeros((replay_capacity, input_height, input_width),
+                         dtype='uint8'))
+            positions = T.lvector('positions')
+            frames = T.tensor3('frames', dtype='uint8')
+            self._store_frames = theano.function(
+                [positions, frames], [],
+                updates={self.replay_shared: T.set_subtensor(
+                    self.replay_shared[positions], frames)})
+
+            starts = T.lvector('starts')
+            window_positions = ((starts.dimshuffle(0, 'x') +
+                                 T.arange(num_frames + n_step)) %
+                                replay_capacity)
+            index_givens = dict(givens)
+            index_givens[windows] = T.cast(
+                self.replay_shared[window_positions], input_dtype)
+            index_givens[next_offset] = n_step
+            self._train_indices = theano.function(
+                [starts, n_step], [loss, q_vals, diff],
+                updates=updates, givens=index_givens)
+            self.startup_times.append(('compile replay',
+                                       time.time() - start))
+
+        start = time.time()
+        phis = T.tensor4('phis', dtype=input_dtype)
+        self._q_vals = theano.function(
+            [], lasagne.layers.get_output(self.l_out, scale(phis)),
+            givens={phis: self.states_shared})
+
+        # Acting needs the q values of a single state.  The
+        # cuda-convnet layers are built for the training batch size, so
+        # those networks evaluate a padded batch instead.
+        self._state = np.zeros((1, num_frames, input_height, input_width),
+                               dtype=input_dtype)
+        self.state_shared = theano.shared(self._state)
+        if network_type in ('nature_cuda', 'nips_cuda'):
+            self._q_vals_single = None
+            self._padded_states = np.zeros(
+                (batch_size, num_frames, input_height, input_width),
+                dtype=input_dtype)
+        else:
+            self._q_vals_single = theano.function(
+                [], lasagne.layers.get_output(self.l_out, scale(phis))[0],
+                givens={phis: self.state_shared})
+        self.startup_times.append(('compile q_vals', time.time() - start))
+
+        if cache_dir is not None:
+            start = time.time()
+            self._save_cached(cache_file)
+            self.startup_times.append(('save cache', time.time() - start))
+
+    def _cache_key(self):
+        """
+        Return a hash of everything the compiled functions depend on:
+        the constructor arguments, the theano flags that affect
+        compilation, the library versions and the network code.
+        """
+        flags = [theano.config.floatX, theano.config.device,
+                 theano.config.mode, theano.config.optimizer,
+                 theano.config.blas.ldflags, theano.config.openmp,
+                 theano.__version__, lasagne.__version__]
+        key = hashlib.sha1(json.dumps([self.config, flags], sort_keys=True))
+        for module in (__name__, 'updates'):
+            filename = os.path.splitext(sys.modules[module].__file__)[0]
+            with open(filename + '.py', 'rb') as handle:
+                key.update(handle.read())
+        return key.hexdigest()
+
+    def _load_cached(self, cache_file):
+        """
+        Take over the layers, shared variables and compiled functions of
+        the learner pickled in cache_file, with freshly initialized
+        parameters.  Return False if there is no usable cache file.
+        """
+        start = time.time()
+        try:
+            with open(cache_file, 'rb') as handle:
+                cached = cPickle.load(handle)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return False
+        self.__dict__.update(cached.__dict__)
+        loaded = time.time()
+
+        # The cached parameters are the initial ones of whichever run
+        # filled the cache; draw new ones.
+        config = self.config
+        initial = self.build_network(config['network_type'],
+                                     config['input_width'],
+                                     config['input_height'],
+                                     config['num_actions'],
+                                     config['num_frames'],
+                                     config['batch_size'])
+        lasagne.layers.helper.set_all_param_values(
+            self.l_out, lasagne.layers.helper.get_all_param_values(initial))
+        if self.freeze_interval > 0:
+            self.reset_q_hat()
+        if self.replay_capacity > 0:
+            self.reset_replay()
+        self.startup_times = [('load cache', loaded - start),
+                              ('init parameters', time.time() - loaded)]
+        return True
+
+    def _save_cached(self, cache_file):
+        """
+        Pickle this learner, before any training, to cache_file.
+        """
+        cache_dir = os.path.dirname(cache_file)
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+        # Compiled graphs are deeply nested.
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+        # Write to a temporary file first, so that concurrent runs only
+        # ever see a complete cache file.
+        descriptor, temp_file = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(descriptor, 'wb') as handle:
+            with self.replay_detached():
+                cPickle.dump(self, handle, -1)
+        os.rename(temp_file, cache_file)
 
     def build_network(self, network_type, input_width, input_height,
                       output_dim, num_frames, batch_size):
@@ -145,6 +381,14 @@ class DeepQLearner:
             return self.build_nips_network_dnn(input_width, input_height,
                                                output_dim, num_frames,
                                                batch_size)
+        elif network_type == "nature_cpu":
+            return self.build_nature_network_cpu(input_width, input_height,
+                                                 output_dim, num_frames,
+                                                 batch_size)
+        elif network_type == "nips_cpu":
+            return self.build_nips_network_cpu(input_width, input_height,
+                                               output_dim, num_frames,
+                                               batch_size)
         elif network_type == "1D_cuda":
             return self.build_1dconv_network(input_width, input_height,
                                                output_dim, num_frames,
@@ -153,13 +397,18 @@ class DeepQLearner:
             return self.build_1dconv_network_dnn(input_width, input_height,
                                                output_dim, num_frames,
                                                batch_size)
+        elif network_type == "1D_cpu":
+            return self.build_1dconv_network_cpu(input_width, input_height,
+                                                 output_dim, num_frames,
+                                                 batch_size)
         elif network_type == "linear":
             return self.build_linear_network(input_width, input_height,
                                              output_dim, num_frames, batch_size)
         else:
             raise ValueError("Unrecognized network: {}".format(network_type))
 
-    def train(self, states, actions, rewards, next_states, terminals):
+    def train(self, states, actions, rewards, next_states, terminals,
+              weights=None, n_step=1):
         """
         Train one batch.
 
@@ -169,32 +418,267 @@ class DeepQLearner:
                  f is num frames, h is height and w is width.
         actions - b x 1 numpy array of integers
         rewards - b x 1 numpy array
-        next_states - b x f x h x w numpy array
+        next_states - b x f x h x w numpy array.  If states and
+                      next_states are the two views of one
+                      b x (f + n) x h x w window that DataSet batches
+                      use, only the window is transferred.
         terminals - b x 1 numpy boolean array (currently ignored)
+        weights - optional b x 1 numpy array of importance-sampling
+                  weights for the squared errors
+        n_step - number of steps the rewards and next_states span;
+                 the next q values are discounted by gamma ** n_step
 
-        Returns: average loss
+        Returns: average loss, and the b x 1 TD errors if weights
+                 were given
         """
 
-        self.states_shared.set_value(states)
-        # print "Input shape: {}".format(self.states_shared.get_value().shape)
-        self.next_states_shared.set_value(next_states)
+        windows, next_offset = _shared_window(states, next_states)
+        if windows is None:
+            windows = np.concatenate((states, next_states), axis=1)
+            next_offset = self.num_frames
+        self.windows_shared.set_value(
+            np.asarray(windows, dtype=self.input_dtype))
+        # print "Input shape: {}".format(self.windows_shared.get_value().shape)
+        self._prepare_update(actions, rewards, weights)
+        loss, _, td_errors = self._train(next_offset, n_step)
+        self.update_counter += 1
+        if weights is not None:
+            return np.sqrt(loss), td_errors
+        return np.sqrt(loss)
+
+    def train_many(self, states, actions, rewards, next_states, terminals,
+                   weights=None, n_step=1):
+        """
+        Train k batches, one update after the other, in a single call
+        to a compiled function.
+
+        Arguments are those of train with a leading k axis, e.g. states
+        is k x b x f x h x w.  If states and next_states are views of
+        one k x b x (f + n) x h x w window (e.g. a DataSet batch of
+        k * b samples reshaped), only the window is transferred.
+
+        Returns: the k average losses, and the k x b x 1 TD errors if
+                 weights were given
+        """
+        if self._train_many is None:
+            self._train_many = self._compile_train_many()
+
+        num_batches = states.shape[0]
+        windows, next_offset = _shared_window(
+            states.reshape((-1,) + states.shape[2:]),
+            next_states.reshape((-1,) + next_states.shape[2:]))
+        if windows is None:
+            windows = np.concatenate((states, next_states), axis=2)
+            next_offset = self.num_frames
+        windows = np.asarray(windows, dtype=self.input_dtype).reshape(
+            (num_batches, self.batch_size) + windows.shape[-3:])
+        return_td_errors = weights is not None
+        if weights is None:
+            weights = np.ones((num_batches, self.batch_size, 1),
+                              dtype=theano.config.floatX)
+
+        losses = []
+        td_errors = []
+        start = 0
+        while start < num_batches:
+            # Split at the updates before which the target network is
+            # reset, as it is in train.
+            stop = num_batches
+            if self._sync_interval > 0:
+                if self.update_counter % self._sync_interval == 0:
+                    self.reset_q_hat()
+                stop = min(stop, start + self._sync_interval -
+                           self.update_counter % self._sync_interval)
+            self.windows_many_shared.set_value(windows[start:stop])
+            self.actions_many_shared.set_value(actions[start:stop])
+            self.rewards_many_shared.set_value(rewards[start:stop])
+            self.weights_many_shared.set_value(weights[start:stop])
+            chunk_losses, chunk_td_errors = self._train_many(next_offset,
+                                                             n_step)
+            losses.append(chunk_losses)
+            td_errors.append(chunk_td_errors)
+            self.update_counter += stop - start
+            start = stop
+
+        losses = np.sqrt(np.concatenate(losses))
+        if return_td_errors:
+            return losses, np.concatenate(td_errors)
+        return losses
+
+    def _compile_train_many(self):
+        """
+        Compile a scan that applies the updates of _train once per batch
+        in the *_many_shared variables.
+        """
+        inputs, scalars, outputs, updates = self._update_graph
+        self.windows_many_shared = theano.shared(
+            np.zeros((1,) + self.windows_shared.get_value().shape,
+                     dtype=self.input_dtype))
+        self.actions_many_shared = theano.shared(
+            np.zeros((1, self.batch_size, 1), dtype='int32'),
+            broadcastable=(False, False, True))
+        self.rewards_many_shared = theano.shared(
+            np.zeros((1, self.batch_size, 1), dtype=theano.config.floatX),
+            broadcastable=(False, False, True))
+        self.weights_many_shared = theano.shared(
+            np.ones((1, self.batch_size, 1), dtype=theano.config.floatX),
+            broadcastable=(False, False, True))
+
+        def update(*step_inputs):
+            # Clone everything at once, so the gradients are shared.
+            cloned = theano.clone(outputs + updates.values(),
+                                  replace=dict(zip(inputs + scalars,
+                                                   step_inputs)))
+            return (cloned[:len(outputs)],
+                    OrderedDict(zip(updates.keys(), cloned[len(outputs):])))
+
+        next_offset = T.iscalar('next_offset')
+        n_step = T.iscalar('n_step')
+        (losses, td_errors), scan_updates = theano.scan(
+            update,
+            sequences=[self.windows_many_shared, self.rewards_many_shared,
+                       self.actions_many_shared, self.weights_many_shared],
+            non_sequences=[next_offset, n_step])
+        return theano.function([next_offset, n_step], [losses, td_errors],
+                               updates=scan_updates)
+
+    def store_frames(self, indices, frames):
+        """
+        Copy frames (n x h x w) into the network's replay memory as the
+        frames with the given logical indices.
+        """
+        self._store_frames(
+            np.asarray(indices, dtype='int64') % self.replay_capacity,
+            np.asarray(frames, dtype='uint8'))
+
+    def train_indices(self, starts, actions, rewards, terminals,
+                      weights=None, n_step=1):
+        """
+        Train one batch whose states are the frames stored (with
+        store_frames) at starts[i] to starts[i] + f - 1, and whose
+        next states start n_step frames later.  Only the indices and
+        the b x 1 columns are transferred; the other arguments and the
+        return value are as for train.
+        """
+        self._prepare_update(actions, rewards, weights)
+        loss, _, td_errors = self._train_indices(
+            np.asarray(starts, dtype='int64'), n_step)
+        self.update_counter += 1
+        if weights is not None:
+            return np.sqrt(loss), td_errors
+        return np.sqrt(loss)
+
+    @contextlib.contextmanager
+    def replay_detached(self):
+        """
+        Empty the replay memory for the duration of the block, e.g. to
+        pickle the network without it.  The frames are back afterwards.
+        """
+        if self.replay_capacity == 0:
+            yield
+            return
+        frames = self.replay_shared.get_value(borrow=True,
+                                              return_internal_type=True)
+        self.replay_shared.set_value(
+            np.zeros((0, self.input_height, self.input_width),
+                     dtype='uint8'))
+        try:
+            yield
+        finally:
+            self.replay_shared.set_value(frames, borrow=True)
+
+    def save_weights(self, filename):
+        """
+        Save the parameters of the network and the arguments it was
+        built with to the .npz file filename, for load_network.  The
+        optimizer state and the replay memory are not saved, and
+        neither is its capacity.
+        """
+        params = lasagne.layers.helper.get_all_param_values(self.l_out)
+        arrays = dict(('param_{}'.format(i), value)
+                      for i, value in enumerate(params))
+        config = dict(self.config)
+        del config['replay_capacity']
+        np.savez(filename, config=json.dumps(config),
+                 update_counter=self.update_counter, **arrays)
+
+    def export_policy(self, filename):
+        """
+        Write the layers of the network to the .npz file filename, for
+        numpy_policy.NumpyPolicy to evaluate without theano or lasagne.
+        """
+        layers = lasagne.layers.get_all_layers(self.l_out)
+        specs = []
+        arrays = {}
+        for layer in layers[1:]:
+            spec, params = _export_layer(layer)
+            for name, value in params.items():
+                arrays['{}_{}'.format(name, len(specs))] = value
+            specs.append(spec)
+        config = {'input_shape': list(layers[0].shape[1:]),
+                  'input_scale': self.config['input_scale'],
+                  'num_actions': self.num_actions,
+                  'layers': specs}
+        np.savez(filename, config=json.dumps(config), **arrays)
+
+    def reset_replay(self):
+        """
+        Allocate an empty replay memory, e.g. for a network that was
+        pickled inside replay_detached.
+        """
+        self.replay_shared.set_value(
+            np.zeros((self.replay_capacity, self.input_height,
+                      self.input_width), dtype='uint8'))
+
+    def _prepare_update(self, actions, rewards, weights):
         self.actions_shared.set_value(actions)
         self.rewards_shared.set_value(rewards)
         #self.terminals_shared.set_value(np.logical_not(terminals))
-        if (self.freeze_interval > 0 and
-            self.update_counter % self.freeze_interval == 0):
+        if weights is not None:
+            self.weights_shared.set_value(weights)
+            self._uniform_weights = False
+        elif not self._uniform_weights:
+            self.weights_shared.set_value(
+                np.ones((self.batch_size, 1), dtype=theano.config.floatX))
+            self._uniform_weights = True
+        if (self._sync_interval > 0 and
+            self.update_counter % self._sync_interval == 0):
             self.reset_q_hat()
-        loss, _ = self._train()
-        self.update_counter += 1
-        return np.sqrt(loss)
 
     def q_vals(self, state):
-        states = np.zeros((self.batch_size, self.num_frames, self.input_height,
-                           self.input_width), dtype=theano.config.floatX)
-        states[0, ...] = state
-        self.states_shared.set_value(states)
+        if self._q_vals_single is not None:
+            self._state[0, ...] = state
+            self.state_shared.set_value(self._state, borrow=True)
+            return self._q_vals_single()
+
+        self._padded_states[0, ...] = state
+        self.states_shared.set_value(self._padded_states)
         return self._q_vals()[0]
 
+    def batch_q_vals(self, states, chunk_size=256):
+        """
+        Return the q values of every state in states, an array of shape
+        (n, num_frames, height, width), as an (n, num_actions) array.
+        The states are evaluated chunk_size at a time (batch_size at a
+        time for the cuda-convnet networks).
+        """
+        if self._q_vals_single is None:
+            # The layers only take batches of batch_size; pad the last
+            # chunk.
+            chunk_size = self.batch_size
+        else:
+            chunk_size = min(chunk_size, len(states))
+        chunk = np.zeros((chunk_size, self.num_frames, self.input_height,
+                          self.input_width), dtype=self.input_dtype)
+        q_vals = np.empty((len(states), self.num_actions),
+                          dtype=theano.config.floatX)
+        for start in range(0, len(states), chunk_size):
+            count = min(chunk_size, len(states) - start)
+            chunk[:count] = states[start:start + count]
+            self.states_shared.set_value(chunk, borrow=True)
+            q_vals[start:start + count] = self._q_vals()[:count]
+        return q_vals
+
     def choose_action(self, state, epsilon):
         if np.random.rand() < epsilon:
             return np.random.randint(0, self.num_actions)
@@ -202,8 +686,7 @@ class DeepQLearner:
         return np.argmax(q_vals)
 
     def reset_q_hat(self):
-        all_params = lasagne.layers.helper.get_all_param_values(self.l_out)
-        lasagne.layers.helper.set_all_param_values(self.next_l_out, all_params)
+        self._reset_q_hat()
 
     def build_nature_network(self, input_width, input_height, output_dim,
                              num_frames, batch_size):
@@ -329,6 +812,70 @@ class DeepQLearner:
 
 
 
+    def build_nature_network_cpu(self, input_width, input_height, output_dim,
+                                 num_frames, batch_size):
+        """
+        Build a large network consistent with the DeepMind Nature paper,
+        without a GPU.  The layers and parameters are those of the cuDNN
+        and cuda-convnet versions, so weights load into either.
+        """
+        # The batch size is left open, so that q_vals can evaluate a
+        # single state.
+        l_in = lasagne.layers.InputLayer(
+            shape=(None, num_frames, input_width, input_height)
+        )
+
+        l_conv1 = lasagne.layers.Conv2DLayer(
+            l_in,
+            num_filters=32,
+            filter_size=(8, 8),
+            stride=(4, 4),
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.HeUniform(),
+            b=lasagne.init.Constant(.1),
+            convolution=_cross_correlate
+        )
+
+        l_conv2 = lasagne.layers.Conv2DLayer(
+            l_conv1,
+            num_filters=64,
+            filter_size=(4, 4),
+            stride=(2, 2),
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.HeUniform(),
+            b=lasagne.init.Constant(.1),
+            convolution=_cross_correlate
+        )
+
+        l_conv3 = lasagne.layers.Conv2DLayer(
+            l_conv2,
+            num_filters=64,
+            filter_size=(3, 3),
+            stride=(1, 1),
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.HeUniform(),
+            b=lasagne.init.Constant(.1),
+            convolution=_cross_correlate
+        )
+
+        l_hidden1 = lasagne.layers.DenseLayer(
+            l_conv3,
+            num_units=512,
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.HeUniform(),
+            b=lasagne.init.Constant(.1)
+        )
+
+        l_out = lasagne.layers.DenseLayer(
+            l_hidden1,
+            num_units=output_dim,
+            nonlinearity=None,
+            W=lasagne.init.HeUniform(),
+            b=lasagne.init.Constant(.1)
+        )
+
+        return l_out
+
     def build_nips_network(self, input_width, input_height, output_dim,
                            num_frames, batch_size):
         """
@@ -440,6 +987,57 @@ class DeepQLearner:
         return l_out
 
 
+    def build_nips_network_cpu(self, input_width, input_height, output_dim,
+                               num_frames, batch_size):
+        """
+        Build a network consistent with the 2013 NIPS paper, without a
+        GPU.  Weights are interchangeable with the nips_dnn and
+        nips_cuda networks.
+        """
+        l_in = lasagne.layers.InputLayer(
+            shape=(None, num_frames, input_width, input_height)
+        )
+
+        l_conv1 = lasagne.layers.Conv2DLayer(
+            l_in,
+            num_filters=16,
+            filter_size=(8, 8),
+            stride=(4, 4),
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.Normal(.01),
+            b=lasagne.init.Constant(.1),
+            convolution=_cross_correlate
+        )
+
+        l_conv2 = lasagne.layers.Conv2DLayer(
+            l_conv1,
+            num_filters=32,
+            filter_size=(4, 4),
+            stride=(2, 2),
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.Normal(.01),
+            b=lasagne.init.Constant(.1),
+            convolution=_cross_correlate
+        )
+
+        l_hidden1 = lasagne.layers.DenseLayer(
+            l_conv2,
+            num_units=256,
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.Normal(.01),
+            b=lasagne.init.Constant(.1)
+        )
+
+        l_out = lasagne.layers.DenseLayer(
+            l_hidden1,
+            num_units=output_dim,
+            nonlinearity=None,
+            W=lasagne.init.Normal(.01),
+            b=lasagne.init.Constant(.1)
+        )
+
+        return l_out
+
     def build_linear_network(self, input_width, input_height, output_dim,
                              num_frames, batch_size):
         """
@@ -561,6 +1159,499 @@ class DeepQLearner:
 
         return l_out
 
+    def build_1dconv_network_cpu(self, input_width, input_height, output_dim,
+                                 num_frames, batch_size):
+        """
+        Build the 1D convolutional network of 1D_dnn without a GPU.
+        """
+        l_in = lasagne.layers.InputLayer(
+            shape=(None, num_frames, input_height, input_width)
+        )
+
+        # cuDNN pads 'same' by (filter_size - 1) // 2 on both sides,
+        # which differs from Conv2DLayer's 'same' for even filters.
+        l_conv1 = lasagne.layers.Conv2DLayer(
+            l_in,
+            num_filters=16,
+            filter_size=(input_height, 8),
+            stride=(4,1),
+            pad=((input_height - 1) // 2, (8 - 1) // 2),
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.Normal(.01),
+            b=lasagne.init.Constant(.1),
+            convolution=_cross_correlate
+        )
+
+        l_maxpool1 = lasagne.layers.MaxPool2DLayer(
+            l_conv1,
+            pool_size=(1,4)
+        )
+
+        l_conv2 = lasagne.layers.Conv2DLayer(
+            l_maxpool1,
+            num_filters=32,
+            filter_size=(input_height,4),
+            stride=(2,1),
+            pad=((input_height - 1) // 2, (4 - 1) // 2),
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.Normal(.01),
+            b=lasagne.init.Constant(.1),
+            convolution=_cross_correlate
+        )
+
+        l_maxpool2 = lasagne.layers.MaxPool2DLayer(
+            l_conv2,
+            pool_size=(1,2)
+        )
+
+        l_hidden1 = lasagne.layers.DenseLayer(
+            l_maxpool2,
+            num_units=256,
+            nonlinearity=lasagne.nonlinearities.rectify,
+            W=lasagne.init.Normal(.01),
+            b=lasagne.init.Constant(.1)
+        )
+
+        l_out = lasagne.layers.DenseLayer(
+            l_hidden1,
+            num_units=output_dim,
+            nonlinearity=None,
+            W=lasagne.init.Constant(0.01),
+            b=lasagne.init.Constant(.1)
+        )
+
+        return l_out
+
+
+def _cross_correlate(input, filters, image_shape=None, **kwargs):
+    """
+    Theano's conv2d without flipping the filters, which is what the
+    cuDNN and cuda-convnet layers compute.  On the CPU it is carried out
+    as CorrMM, i.e. im2col and a BLAS gemm.
+    """
+    return T.nnet.conv2d(input, filters, input_shape=image_shape,
+                         filter_flip=False, **kwargs)
+
+
+_NONLINEARITIES = {'identity': lasagne.nonlinearities.identity,
+                   'rectify': lasagne.nonlinearities.rectify,
+                   'sigmoid': lasagne.nonlinearities.sigmoid}
+
+
+def _export_layer(layer):
+    """
+    Return the description of layer that export_policy writes, and a
+    dict of its parameter arrays.  Convolution filters are exported for
+    cross-correlation, whichever backend the layer uses.
+    """
+    kind = type(layer).__name__
+    spec = {}
+    params = {}
+    if hasattr(layer, 'nonlinearity'):
+        for name, function in _NONLINEARITIES.items():
+            if layer.nonlinearity is function:
+                spec['nonlinearity'] = name
+        if 'nonlinearity' not in spec:
+            raise ValueError("Can not export the nonlinearity of "
+                             "{}.".format(layer))
+    if getattr(layer, 'b', None) is not None:
+        params['b'] = layer.b.get_value()
+
+    if kind in ('Conv2DLayer', 'Conv2DDNNLayer', 'Conv2DCCLayer'):
+        if layer.untie_biases or not getattr(layer, 'dimshuffle', True):
+            raise ValueError("Can not export {}.".format(layer))
+        filters = layer.W.get_value()
+        if kind == 'Conv2DLayer':
+            flip = layer.convolution is not _cross_correlate
+        else:
+            flip = layer.flip_filters
+        if flip:
+            filters = filters[:, :, ::-1, ::-1]
+        sizes = filters.shape[2:]
+        if layer.pad == 'full':
+            pad = [(size - 1, size - 1) for size in sizes]
+        elif layer.pad == 'same':
+            # As Conv2DLayer pads it.
+            pad = [(size // 2, (size - 1) // 2) for size in sizes]
+        else:
+            pad = [(width, width) for width in _pair(layer.pad)]
+        spec.update(type='conv', filter_size=list(sizes),
+                    stride=_pair(layer.stride), pad=pad)
+        params['W'] = np.ascontiguousarray(filters)
+    elif kind in ('MaxPool2DLayer', 'MaxPool2DDNNLayer'):
+        if (any(_pair(layer.pad)) or getattr(layer, 'mode', 'max') != 'max'
+            or not getattr(layer, 'ignore_border', True)):
+            raise ValueError("Can not export {}.".format(layer))
+        spec.update(type='maxpool', pool_size=_pair(layer.pool_size),
+                    stride=_pair(layer.stride))
+    elif kind == 'DenseLayer':
+        spec['type'] = 'dense'
+        params['W'] = layer.W.get_value()
+    else:
+        raise ValueError("Can not export {} layers.".format(kind))
+    return spec, params
+
+
+def _pair(value):
+    if isinstance(value, (tuple, list)):
+        return [int(value[0]), int(value[1])]
+    return [int(value), int(value)]
+
+
+def load_params(filename):
+    """
+    Return the parameter values saved in filename, in the order of
+    lasagne.layers.get_all_params, without building the network.  Old
+    pickled networks (.pkl) are read as well.
+    """
+    if filename.endswith('.pkl'):
+        with open(filename, 'rb') as handle:
+            network = cPickle.load(handle)
+        return lasagne.layers.helper.get_all_param_values(network.l_out)
+    # Members of an npz are only read when they are accessed.
+    weights = np.load(filename)
+    num_params = sum(1 for key in weights.files if key.startswith('param_'))
+    return [weights['param_{}'.format(i)] for i in range(num_params)]
+
+
+def load_network(filename, **kwargs):
+    """
+    Rebuild the DeepQLearner saved in filename with save_weights.
+    Keyword arguments override the saved constructor arguments, e.g.
+    freeze_interval=0 to skip the target network when only evaluating
+    (which also turns off target_tau, unless it is given as well).
+    The network has no replay memory unless replay_capacity is given.
+
+    Pickled networks (.pkl) are rebuilt the same way from the
+    attributes of the unpickled learner, so that older ones get the
+    current compiled functions.
+    """
+    if filename.endswith('.pkl'):
+        with open(filename, 'rb') as handle:
+            pickled = cPickle.load(handle)
+        config = _pickled_config(pickled)
+        params = lasagne.layers.helper.get_all_param_values(pickled.l_out)
+        update_counter = pickled.update_counter
+        del pickled
+    else:
+        weights = np.load(filename)
+        config = json.loads(str(weights['config']))
+        params = load_params(filename)
+        update_counter = int(weights['update_counter'])
+    # Saved by earlier versions of save_weights.
+    config.pop('replay_capacity', None)
+    if kwargs.get('freeze_interval', 1) <= 0:
+        config['target_tau'] = 0
+    config.update(kwargs)
+    network = DeepQLearner(**config)
+    lasagne.layers.helper.set_all_param_values(network.l_out, params)
+    network.update_counter = update_counter
+    if network.freeze_interval > 0:
+        network.reset_q_hat()
+    return network
+
+
+def _pickled_config(network):
+    """
+    Return the constructor arguments of a pickled DeepQLearner.
+    Learners pickled before save_weights existed do not record their
+    network type, which is recognized from their layers, nor their
+    update rule, batch accumulator and input scale, which get defaults.
+    """
+    if hasattr(network, 'config'):
+        return dict(network.config)
+    config = {'input_width': network.input_width,
+              'input_height': network.input_height,
+              'num_actions': network.num_actions,
+              'num_frames': network.num_frames,
+              'discount': network.gamma,
+              'learning_rate': network.lr,
+              'rho': network.rho,
+              'rms_epsilon': network.rms_epsilon,
+              'momentum': network.momentum,
+              'freeze_interval': network.freeze_interval,
+              'batch_size': network.batch_size,
+              'update_rule': 'rmsprop',
+              'batch_accumulator': 'mean'}
+    layers = _layer_shapes(network.l_out)
+    for network_type in ('linear', 'nips_dnn', 'nature_dnn', '1D_dnn',
+                         'nips_cuda', 'nature_cuda'):
+        try:
+            l_out = network.build_network(
+                network_type, config['input_width'], config['input_height'],
+                config['num_actions'], config['num_frames'],
+                config['batch_size'])
+        except ImportError:
+            # The pickle would not have loaded without the backend.
+            continue
+        if _layer_shapes(l_out) == layers:
+            config['network_type'] = network_type
+            return config
+    raise ValueError("Unrecognized pickled network.")
+
+
+def _layer_shapes(l_out):
+    """ Return the type and parameter shapes of every layer. """
+    return [(type(layer).__name__,
+             [param.get_value().shape for param in layer.get_params()])
+            for layer in lasagne.layers.get_all_layers(l_out)]
+
+
+def _shared_window(states, next_states):
+    """
+    Return the array that states and next_states are the first and last
+    images of (as in a DataSet batch) and the offset of next_states in
+    it, or (None, None) if they are not laid out that way.
+    """
+    windows = states.base
+    if (windows is None or next_states.base is not windows or
+        windows.ndim != 4 or windows.shape[0] != states.shape[0] or
+        windows.shape[1] <= states.shape[1]):
+        return None, None
+    start = windows.__array_interface__['data'][0]
+    offset = windows.shape[1] - states.shape[1]
+    if (states.__array_interface__['data'][0] != start or
+        next_states.__array_interface__['data'][0] !=
+        start + offset * windows.strides[1]):
+        return None, None
+    return windows, offset
+
+# TESTING CODE BELOW THIS POINT...
+
+def _test_networks(count, **kwargs):
+    """ Return count linear networks built with the same arguments and
+    the same random parameters.
+    """
+    arguments = dict(input_width=3, input_height=2, num_actions=3,
+                     num_frames=4, discount=.9, learning_rate=.01, rho=.95,
+                     rms_epsilon=.01, momentum=0, freeze_interval=0,
+                     batch_size=5, network_type='linear',
+                     update_rule='rmsprop', input_dtype='uint8')
+    arguments.update(kwargs)
+    networks = [DeepQLearner(**arguments) for _ in range(count)]
+    rng = np.random.RandomState(0)
+    values = [rng.normal(0, .1, value.shape).astype(value.dtype)
+              for value in lasagne.layers.helper.get_all_param_values(
+                  networks[0].l_out)]
+    for network in networks:
+        lasagne.layers.helper.set_all_param_values(network.l_out, values)
+        if network.freeze_interval > 0:
+            network.reset_q_hat()
+    return networks
+
+
+def _param_values(network):
+    return lasagne.layers.helper.get_all_param_values(network.l_out)
+
+
+def test_train_indices():
+    rng = np.random.RandomState(1)
+    capacity = 13
+    frames = rng.randint(0, 256, (40, 2, 3)).astype('uint8')
+    for input_dtype in ('uint8', theano.config.floatX):
+        device, host = _test_networks(2, input_dtype=input_dtype,
+                                      replay_capacity=capacity,
+                                      freeze_interval=3)
+        assert device.replay_shared.get_value().dtype == np.uint8
+        stored = 0
+        wrapped = False
+        for step in range(8):
+            for n_step in (1, 2):
+                # Store a few frames at a time, so that positions wrap
+                # around the end of the replay memory.
+                count = min(len(frames), 20 + 3 * step)
+                device.store_frames(np.arange(stored, count),
+                                    frames[stored:count])
+                stored = count
+                starts = rng.randint(count - capacity,
+                                     count - 4 - n_step + 1, 5)
+                actions = rng.randint(0, 3, (5, 1)).astype('int32')
+                rewards = rng.normal(0, 1, (5, 1)).astype(
+                    theano.config.floatX)
+                terminals = np.zeros((5, 1), dtype='bool')
+                windows = frames[starts[:, np.newaxis] +
+                                 np.arange(4 + n_step)]
+                wrapped |= np.any(starts % capacity + 4 + n_step >
+                                  capacity)
+                expected = host.train(windows[:, :4], actions, rewards,
+                                      windows[:, n_step:], terminals,
+                                      n_step=n_step)
+                loss = device.train_indices(starts, actions, rewards,
+                                            terminals, n_step=n_step)
+                np.testing.assert_allclose(loss, expected, rtol=1e-5)
+        assert wrapped
+        for value, expected in zip(_param_values(device),
+                                   _param_values(host)):
+            np.testing.assert_allclose(value, expected, rtol=1e-5,
+                                       atol=1e-6)
+    print "passed"
+
+
+def test_train_many_matches_train():
+    rng = np.random.RandomState(2)
+    num_batches = 7
+    for freeze_interval in (0, 3):
+        sequential, many = _test_networks(2, freeze_interval=freeze_interval)
+        windows = rng.randint(0, 256, (num_batches + 1, 5, 5, 2, 3)).astype(
+            'uint8')
+        actions = rng.randint(0, 3, (num_batches + 1, 5, 1)).astype('int32')
+        rewards = rng.normal(0, 1, (num_batches + 1, 5, 1)).astype(
+            theano.config.floatX)
+        terminals = np.zeros((num_batches + 1, 5, 1), dtype='bool')
+        weights = rng.uniform(.5, 1, (num_batches + 1, 5, 1)).astype(
+            theano.config.floatX)
+
+        # One update first, so that train_many starts between two
+        # target network resets.
+        for network in (sequential, many):
+            network.train(windows[0, :, :4], actions[0], rewards[0],
+                          windows[0, :, 1:], terminals[0])
+        expected = [sequential.train(windows[i, :, :4], actions[i],
+                                     rewards[i], windows[i, :, 1:],
+                                     terminals[i], weights[i])
+                    for i in range(1, num_batches + 1)]
+        losses, td_errors = many.train_many(
+            windows[1:, :, :4], actions[1:], rewards[1:],
+            windows[1:, :, 1:], terminals[1:], weights[1:])
+
+        assert many.update_counter == sequential.update_counter
+        np.testing.assert_allclose(losses, [loss for loss, _ in expected],
+                                   rtol=1e-5)
+        np.testing.assert_allclose(td_errors,
+                                   [errors for _, errors in expected],
+                                   rtol=1e-4, atol=1e-6)
+        for value, expected_value in zip(_param_values(many),
+                                         _param_values(sequential)):
+            np.testing.assert_allclose(value, expected_value, rtol=1e-5,
+                                       atol=1e-6)
+        if freeze_interval > 0:
+            for value, expected_value in zip(
+                    lasagne.layers.helper.get_all_param_values(
+                        many.next_l_out),
+                    lasagne.layers.helper.get_all_param_values(
+                        sequential.next_l_out)):
+                np.testing.assert_allclose(value, expected_value,
+                                           rtol=1e-5, atol=1e-6)
+    print "passed"
+
+
+def _target_values(network):
+    return lasagne.layers.helper.get_all_param_values(network.next_l_out)
+
+
+def _train_random(network, rng):
+    windows = rng.randint(0, 256, (5, 5, 2, 3)).astype('uint8')
+    network.train(windows[:, :4], rng.randint(0, 3, (5, 1)).astype('int32'),
+                  rng.normal(0, 1, (5, 1)).astype(theano.config.floatX),
+                  windows[:, 1:], np.zeros((5, 1), dtype='bool'))
+
+
+def test_target_network():
+    rng = np.random.RandomState(3)
+    network, = _test_networks(1, freeze_interval=3)
+    initial = _param_values(network)
+    for _ in range(3):
+        _train_random(network, rng)
+    for value, expected in zip(_target_values(network), initial):
+        np.testing.assert_array_equal(value, expected)
+    # The target network is copied before update freeze_interval + 1.
+    trained = _param_values(network)
+    _train_random(network, rng)
+    for value, expected in zip(_target_values(network), trained):
+        np.testing.assert_array_equal(value, expected)
+    assert not np.allclose(_target_values(network)[0],
+                           _param_values(network)[0])
+
+    tau = .1
+    network, = _test_networks(1, freeze_interval=3, target_tau=tau)
+    for _ in range(4):
+        target = _target_values(network)
+        _train_random(network, rng)
+        for value, old, new in zip(_target_values(network), target,
+                                   _param_values(network)):
+            np.testing.assert_allclose(value, tau * new + (1 - tau) * old,
+                                       rtol=1e-5, atol=1e-7)
+    print "passed"
+
+
+def test_load_for_evaluation():
+    import tempfile
+    network, = _test_networks(1, freeze_interval=3, target_tau=.1)
+    handle, filename = tempfile.mkstemp(suffix='.npz')
+    os.close(handle)
+    try:
+        network.save_weights(filename)
+        evaluating = load_network(filename, freeze_interval=0)
+    finally:
+        os.remove(filename)
+    assert evaluating.target_tau == 0
+    assert not hasattr(evaluating, 'next_l_out')
+    state = np.random.randint(0, 256, (4, 2, 3)).astype('uint8')
+    np.testing.assert_allclose(evaluating.q_vals(state),
+                               network.q_vals(state), rtol=1e-5)
+    print "passed"
+
+
+def test_batch_q_vals():
+    rng = np.random.RandomState(4)
+    network, = _test_networks(1)
+    states = rng.randint(0, 256, (12, 4, 2, 3)).astype('uint8')
+    expected = np.array([network.q_vals(state) for state in states])
+    for count in (3, 12):
+        np.testing.assert_allclose(network.batch_q_vals(states[:count], 5),
+                                   expected[:count], rtol=1e-5)
+
+    # The cuda-convnet networks evaluate padded batches of batch_size.
+    compiled = network._q_vals
+
+    def padded_q_vals():
+        assert network.states_shared.get_value().shape[0] == 5
+        return compiled()
+    network._q_vals_single = None
+    network._q_vals = padded_q_vals
+    for count in (3, 12):
+        np.testing.assert_allclose(network.batch_q_vals(states[:count]),
+                                   expected[:count], rtol=1e-5)
+    print "passed"
+
+
+def test_load_pickled():
+    import tempfile
+    import types
+    network, = _test_networks(1, freeze_interval=10)
+    network.update_counter = 7
+    # A learner as pickled before save_weights: only the attributes
+    # its constructor set then, and its layers.
+    old = types.InstanceType(DeepQLearner)
+    for name in ('input_width', 'input_height', 'num_actions',
+                 'num_frames', 'batch_size', 'gamma', 'rho', 'lr',
+                 'rms_epsilon', 'momentum', 'freeze_interval',
+                 'update_counter', 'l_out', 'next_l_out'):
+        setattr(old, name, getattr(network, name))
+    handle, filename = tempfile.mkstemp(suffix='.pkl')
+    try:
+        with os.fdopen(handle, 'wb') as pickle_file:
+            cPickle.dump(old, pickle_file, -1)
+        loaded = load_network(filename)
+        evaluating = load_network(filename, freeze_interval=0)
+    finally:
+        os.remove(filename)
+
+    assert loaded.config['network_type'] == 'linear'
+    assert loaded.update_counter == 7
+    for value, expected in zip(_param_values(loaded),
+                               _param_values(network)):
+        np.testing.assert_array_equal(value, expected)
+    state = np.random.randint(0, 256, (4, 2, 3)).astype('uint8')
+    np.testing.assert_allclose(evaluating.q_vals(state),
+                               network.q_vals(state), rtol=1e-5)
+    windows = np.random.randint(0, 256, (5, 5, 2, 3)).astype('uint8')
+    loaded.train(windows[:, :4], np.zeros((5, 1), dtype='int32'),
+                 np.ones((5, 1), dtype=theano.config.floatX),
+                 windows[:, 1:], np.zeros((5, 1), dtype='bool'))
+    print "passed"
+
+
 def main():
     net = DeepQLearner(84, 84, 3, 1, .99, .00025, .95, .95, 10000, -1,
                        32, update_rule='deepmind_rmsprop', network_type='1D_dnn')
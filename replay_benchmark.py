@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+"""Benchmark the replay memory (sumo_data_set.DataSet).
+
+For every combination of storage, capacity, frame size, phi_length and
+terminal rate this fills a fresh data set in a separate process and
+measures:
+
+    add_per_sec - add_sample calls per second while filling it
+    batch_per_sec - random_batch calls per second
+    phi_usec - microseconds per phi() call (the acting path)
+    memory_mb - growth of the resident set size while filling it
+
+The results are written as CSV (or JSON lines), one row per
+combination, so that runs can be compared between storage backends
+and commits.
+
+Usage:
+
+replay_benchmark.py --capacities 10000,100000 --storages dense,sparse
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+
+FIELDS = ['storage', 'capacity', 'width', 'height', 'phi_length',
+          'terminal_rate', 'density', 'batch_size', 'add_per_sec',
+          'batch_per_sec', 'phi_usec', 'memory_mb']
+
+
+def resident_mb():
+    """ Return the resident set size of this process in megabytes. """
+    try:
+        with open('/proc/self/statm') as handle:
+            pages = int(handle.read().split()[1])
+        return pages * resource.getpagesize() / 1e6
+    except IOError:
+        # Peak instead of current size, in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def benchmark(storage, capacity, width, height, phi_length, terminal_rate,
+              density, batch_size, num_batches, seed=0):
+    """ Fill one data set and return a dict with the FIELDS. """
+    import sumo_data_set
+
+    rng = np.random.RandomState(seed)
+    # Draw the images up front so that only the data set is timed.
+    images = (rng.random_sample((64, height, width)) <
+              density).astype('uint8')
+    actions = rng.randint(0, 4, size=capacity)
+    rewards = rng.random_sample(capacity)
+    terminals = rng.random_sample(capacity) < terminal_rate
+
+    memory_before = resident_mb()
+    data_set = sumo_data_set.DataSet(width, height, max_steps=capacity,
+                                     phi_length=phi_length,
+                                     storage=storage)
+    start = time.time()
+    for i in xrange(capacity):
+        data_set.add_sample(images[i % len(images)], actions[i],
+                            rewards[i], terminals[i])
+    add_time = time.time() - start
+    memory_mb = resident_mb() - memory_before
+
+    data_set.random_batch(batch_size)
+    start = time.time()
+    for _ in xrange(num_batches):
+        data_set.random_batch(batch_size)
+    batch_time = time.time() - start
+
+    num_phis = 1000
+    start = time.time()
+    for i in xrange(num_phis):
+        data_set.phi(images[i % len(images)])
+    phi_time = time.time() - start
+
+    return {'storage': storage,
+            'capacity': capacity,
+            'width': width,
+            'height': height,
+            'phi_length': phi_length,
+            'terminal_rate': terminal_rate,
+            'density': density,
+            'batch_size': batch_size,
+            'add_per_sec': capacity / add_time,
+            'batch_per_sec': num_batches / batch_time,
+            'phi_usec': 1e6 * phi_time / num_phis,
+            'memory_mb': memory_mb}
+
+
+def _benchmark_star(args):
+    return benchmark(*args)
+
+
+def _int_list(string):
+    return [int(value) for value in string.split(',')]
+
+
+def _float_list(string):
+    return [float(value) for value in string.split(',')]
+
+
+def _size_list(string):
+    return [tuple(int(side) for side in size.split('x'))
+            for size in string.split(',')]
+
+
+def process_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--storages', type=lambda s: s.split(','),
+                        default=['dense', 'packed', 'sparse'],
+                        help=('Comma-separated storage modes. ' +
+                              '(default: dense,packed,sparse)'))
+    parser.add_argument('--capacities', type=_int_list,
+                        default=[10000, 100000],
+                        help=('Comma-separated replay sizes. ' +
+                              '(default: 10000,100000)'))
+    parser.add_argument('--sizes', type=_size_list, default=[(84, 84)],
+                        help=('Comma-separated WIDTHxHEIGHT frame ' +
+                              'sizes. (default: 84x84)'))
+    parser.add_argument('--phi-lengths', dest='phi_lengths',
+                        type=_int_list, default=[4],
+                        help=('Comma-separated phi lengths. ' +
+                              '(default: 4)'))
+    parser.add_argument('--terminal-rates', dest='terminal_rates',
+                        type=_float_list, default=[.001, .05],
+                        help=('Comma-separated fractions of terminal ' +
+                              'samples. (default: .001,.05)'))
+    parser.add_argument('--density', type=float, default=.05,
+                        help=('Fraction of nonzero pixels. ' +
+                              '(default: %(default)s)'))
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        default=32,
+                        help='Batch size. (default: %(default)s)')
+    parser.add_argument('--num-batches', dest='num_batches', type=int,
+                        default=1000,
+                        help=('Batches drawn per combination. ' +
+                              '(default: %(default)s)'))
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv',
+                        help=('csv, or json for one object per line. ' +
+                              '(default: %(default)s)'))
+    parser.add_argument('-o', '--output', default=None,
+                        help='File to write to. (default: stdout)')
+    return parser.parse_args(args)
+
+
+def main(args):
+    parameters = process_args(args)
+    configurations = [(storage, capacity, width, height, phi_length,
+                       terminal_rate, parameters.density,
+                       parameters.batch_size, parameters.num_batches)
+                      for storage in parameters.storages
+                      for capacity in parameters.capacities
+                      for width, height in parameters.sizes
+                      for phi_length in parameters.phi_lengths
+                      for terminal_rate in parameters.terminal_rates]
+
+    if parameters.output is None:
+        output = sys.stdout
+    else:
+        output = open(parameters.output, 'w')
+    if parameters.format == 'csv':
+        writer = csv.DictWriter(output, FIELDS)
+        writer.writeheader()
+
+    # A fresh process for every combination, so that memory use is not
+    # skewed by the ones before it.
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for configuration in configurations:
+            result = pool.apply(_benchmark_star, (configuration,))
+            if parameters.format == 'csv':
+                writer.writerow(result)
+            else:
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+    finally:
+        pool.close()
+        pool.join()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -27,7 +27,6 @@ Original author: Nathan Sprague
 
 import copy
 import os
-import cPickle
 from itertools import cycle
 from rlglue.agent.Agent import Agent
 from rlglue.agent import AgentLoader as AgentLoader
@@ -46,8 +45,9 @@ import argparse
 import matplotlib.pyplot as plt
 
 import sumo_data_set
+from batch_prefetcher import BatchPrefetcher
 import theano
-from q_network import DeepQLearner
+from q_network import DeepQLearner, load_network
 
 import sys
 sys.setrecursionlimit(10000)
@@ -74,7 +74,19 @@ class NeuralAgent(Agent):
                  phi_length, replay_memory_size, exp_pref, nn_file,
                  pause, network_type, update_rule, batch_accumulator,
                  freeze_interval, batch_size, replay_start_size,
-                 update_frequency, image_resize):
+                 update_frequency, image_resize,
+                 replay_storage='dense',
+                 replay_path=None,
+                 priority_alpha=0,
+                 priority_beta=.4,
+                 prefetch_batches=0,
+                 uint8_batches=False,
+                 replay_file=None,
+                 save_replay=False,
+                 n_step=1,
+                 device_replay=False,
+                 graph_cache=None,
+                 target_tau=0):
 
         self.discount = discount
         self.learning_rate = learning_rate
@@ -97,6 +109,18 @@ class NeuralAgent(Agent):
         self.replay_start_size = replay_start_size
         self.update_frequency = update_frequency
         self.image_resize = image_resize
+        self.replay_storage = replay_storage
+        self.replay_path = replay_path
+        self.priority_alpha = priority_alpha
+        self.priority_beta = priority_beta
+        self.prefetch_batches = prefetch_batches
+        self.uint8_batches = uint8_batches
+        self.replay_file = replay_file
+        self.save_replay = save_replay
+        self.n_step = n_step
+        self.device_replay = device_replay
+        self.graph_cache = graph_cache
+        self.target_tau = target_tau
 
         # CREATE A FOLDER TO HOLD RESULTS
         time_str = time.strftime("_%m-%d-%H-%M_", time.gmtime())
@@ -137,16 +161,47 @@ class NeuralAgent(Agent):
         else:
             logging.error("INVALID TASK SPEC")
 
-        self.data_set = sumo_data_set.DataSet(width=CROPPED_WIDTH,
-                                             height=CROPPED_HEIGHT,
-                                             max_steps=self.replay_memory_size,
-                                             phi_length=self.phi_length)
+        if self.n_step > 1 and self.priority_alpha > 0:
+            raise ValueError("Multi-step returns need uniform replay.")
+        if self.device_replay and self.priority_alpha > 0:
+            raise ValueError("Device replay needs uniform replay.")
+
+        if self.uint8_batches:
+            self.batch_dtype = 'uint8'
+        else:
+            self.batch_dtype = floatX
+
+        if self.replay_file is None:
+            self.data_set = sumo_data_set.DataSet(
+                width=CROPPED_WIDTH,
+                height=CROPPED_HEIGHT,
+                max_steps=self.replay_memory_size,
+                phi_length=self.phi_length,
+                storage=self.replay_storage,
+                path=self.replay_path,
+                priority_alpha=self.priority_alpha,
+                batch_dtype=self.batch_dtype,
+                n_step=self.n_step,
+                discount=self.discount)
+        else:
+            self.data_set = sumo_data_set.DataSet.load(
+                self.replay_file,
+                path=self.replay_path,
+                priority_alpha=self.priority_alpha,
+                batch_dtype=self.batch_dtype,
+                n_step=self.n_step,
+                discount=self.discount)
 
         # just needs to be big enough to create phi's
         self.test_data_set = sumo_data_set.DataSet(width=CROPPED_WIDTH,
                                                   height=CROPPED_HEIGHT,
                                                   max_steps=10,
-                                                  phi_length=self.phi_length)
+                                                  phi_length=self.phi_length,
+                                                  batch_dtype=self.batch_dtype)
+        # Started once there is enough data to train on.
+        self.prefetcher = None
+        # Samples before this one are in the network's replay memory.
+        self.frames_uploaded = 0
         self.epsilon = self.epsilon_start
         if self.epsilon_decay != 0:
             self.epsilon_rate = ((self.epsilon_start - self.epsilon_min) /
@@ -160,8 +215,14 @@ class NeuralAgent(Agent):
         if self.nn_file is None:
             self.network = self._init_network()
         else:
-            handle = open(self.nn_file, 'r')
-            self.network = cPickle.load(handle)
+            self.network = load_network(
+                self.nn_file, input_dtype=self.batch_dtype, input_scale=1,
+                replay_capacity=self._replay_capacity(),
+                cache_dir=self.graph_cache)
+        if hasattr(self.network, 'startup_times'):
+            logging.info("network startup: " + ", ".join(
+                "{} {:.2f}s".format(step, seconds)
+                for step, seconds in self.network.startup_times))
 
         self._open_results_file()
         self._open_learning_file()
@@ -198,10 +259,23 @@ class NeuralAgent(Agent):
                             self.network_type,
                             self.update_rule,
                             self.batch_accumulator,
-                            input_scale=1)
+                            input_scale=1,
+                            input_dtype=self.batch_dtype,
+                            replay_capacity=self._replay_capacity(),
+                            cache_dir=self.graph_cache,
+                            target_tau=self.target_tau)
 
 
 
+    def _replay_capacity(self):
+        """
+        The network's replay memory mirrors the data set's buffers, so
+        that sample i is at position i % capacity in both.
+        """
+        if self.device_replay:
+            return self.data_set.capacity
+        return 0
+
     def _open_results_file(self):
         logging.info("OPENING " + self.exp_dir + '/results.csv')
         self.results_file = open(self.exp_dir + '/results.csv', 'w', 0)
@@ -373,11 +447,56 @@ class NeuralAgent(Agent):
         May be overridden if a subclass needs to train the network
         differently.
         """
-        states, actions, rewards, next_states, terminals = \
-                                self.data_set.random_batch(self.batch_size)
+        if self.device_replay:
+            self._upload_frames()
+            starts, actions, rewards, terminals = \
+                self.data_set.random_transitions(self.batch_size, self.n_step)
+            return self.network.train_indices(starts, actions, rewards,
+                                              terminals, n_step=self.n_step)
+
+        if self.prefetch_batches > 0 and self.prefetcher is None:
+            priority_beta = None
+            if self.priority_alpha > 0:
+                priority_beta = self.priority_beta
+            self.prefetcher = BatchPrefetcher(self.data_set, self.batch_size,
+                                              self.prefetch_batches,
+                                              priority_beta, self.n_step)
+            self.prefetcher.start()
+
+        if self.prefetcher is not None:
+            batch = self.prefetcher.get()
+        elif self.priority_alpha > 0:
+            batch = self.data_set.prioritized_batch(self.batch_size,
+                                                    self.priority_beta)
+        else:
+            batch = self.data_set.random_batch(self.batch_size,
+                                               n_step=self.n_step)
+
+        if self.priority_alpha > 0:
+            states, actions, rewards, next_states, terminals, indices, \
+                weights = batch
+            loss, td_errors = self.network.train(states, actions, rewards,
+                                                 next_states, terminals,
+                                                 weights)
+            self.data_set.update_priorities(indices, td_errors)
+            return loss
+
+        states, actions, rewards, next_states, terminals = batch
         return self.network.train(states, actions, rewards,
-                                  next_states, terminals)
+                                  next_states, terminals, n_step=self.n_step)
 
+    def _upload_frames(self):
+        """
+        Copy the samples added since the last call to the network's
+        replay memory.
+        """
+        first = max(self.frames_uploaded,
+                    self.data_set.count - self.data_set.capacity)
+        if first < self.data_set.count:
+            indices = np.arange(first, self.data_set.count)
+            self.network.store_frames(indices,
+                                      self.data_set._frames(indices))
+        self.frames_uploaded = self.data_set.count
 
     def agent_end(self, reward):
         """
@@ -415,7 +534,9 @@ class NeuralAgent(Agent):
         here, but we use the agent_message mechanism instead so that
         a file name can be provided by the experiment.
         """
-        pass
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
 
     def agent_message(self, in_message):
         """
@@ -430,10 +551,11 @@ class NeuralAgent(Agent):
 
         elif in_message.startswith("finish_epoch"):
             epoch = int(in_message.split(" ")[1])
-            net_file = open(self.exp_dir + '/network_file_' + str(epoch) + \
-                            '.pkl', 'w')
-            cPickle.dump(self.network, net_file, -1)
-            net_file.close()
+            self.network.save_weights(self.exp_dir + '/network_file_' +
+                                      str(epoch) + '.npz')
+            self.data_set.flush()
+            if self.save_replay:
+                self.data_set.save(self.exp_dir + '/replay_memory.pkl')
 
         elif in_message.startswith("start_testing"):
             self.testing = True
@@ -446,18 +568,15 @@ class NeuralAgent(Agent):
             epoch = int(in_message.split(" ")[1])
 
             if self.holdout_data is None:
-                self.holdout_data = self.data_set.random_batch(holdout_size)[0]
-
-            holdout_sum = 0
-            for i in range(holdout_size):
-                # print self.holdout_data.shape
-                # print self.holdout_data[i, ...].shape
-                # print self.holdout_data[i, ...]
-                # print self.network.q_vals(self.holdout_data[i, ...])
-                # print np.mean(self.network.q_vals(self.holdout_data[i, ...]))
-                holdout_sum += np.mean(
-                    self.network.q_vals(self.holdout_data[i, ...]))
-                # print holdout_sum
+                # Gather the uint8 frames of the states themselves
+                # rather than a batch: batches are windows in the batch
+                # dtype that the data set reuses.
+                starts = self.data_set.random_transitions(holdout_size)[0]
+                self.holdout_data = self.data_set._frames(
+                    starts[:, np.newaxis] + np.arange(self.phi_length))
+
+            holdout_sum = np.sum(np.mean(
+                self.network.batch_q_vals(self.holdout_data), axis=1))
 
             self._update_results_file(epoch, self.episode_counter,
                                       holdout_sum / holdout_size)
@@ -57,6 +57,18 @@ class Defaults:
     FREEZE_INTERVAL = 10000
     REPLAY_START_SIZE = 50000
     IMAGE_RESIZE = 'scale'
+    REPLAY_STORAGE = 'dense'
+    REPLAY_PATH = None
+    PRIORITY_ALPHA = 0
+    PRIORITY_BETA = .4
+    PREFETCH_BATCHES = 0
+    UINT8_BATCHES = False
+    REPLAY_FILE = None
+    SAVE_REPLAY = False
+    N_STEP = 1
+    DEVICE_REPLAY = False
+    GRAPH_CACHE = None
+    TARGET_TAU = 0
 
 if __name__ == "__main__":
     launcher.launch(sys.argv[1:], Defaults, __doc__)
@@ -0,0 +1,204 @@
+"""Replay memory shared between processes.
+
+Several actor processes, each driving its own SUMO simulation, append
+transitions while a single learner samples minibatches from all of
+them.  The memory is a directory, normally under /dev/shm, holding one
+memory-mapped DataSet segment per actor.  Each actor only ever writes
+to its own segment, so appending needs no cross-process lock; a
+segment is claimed once, with an atomic mkdir.  Every segment publishes
+its sample count after each sample, and the learner picks up new
+samples with DataSet.sync() before drawing a batch.  A batch that an
+actor overwrote while it was being copied is drawn again.
+"""
+
+import os
+import cPickle
+import numpy as np
+import sumo_data_set
+
+floatX = sumo_data_set.floatX
+
+
+class SharedReplay(object):
+    """ The learner's side of a shared replay memory.
+    """
+
+    def __init__(self, path, num_actors, width, height, max_steps=1000,
+                 phi_length=4, margin=1000, storage='dense',
+                 batch_dtype=floatX):
+        """ Create a shared replay memory in the directory path.
+
+        Arguments:
+            path - directory for the segments.  Must not exist yet.
+            num_actors - number of segments, one per actor process.
+            width,height - image size
+            max_steps - the length of history to store, over all actors.
+            phi_length - number of images to concatenate into a state.
+            margin - extra samples kept in every segment, so that an
+                     actor can run that far ahead of the learner's last
+                     sync() without overwriting transitions it samples.
+            storage - 'dense' or 'packed', as for DataSet.
+            batch_dtype - dtype of the images in returned batches.
+        """
+        os.makedirs(path)
+        self.path = path
+        self.header = {'num_actors': num_actors,
+                       'width': width,
+                       'height': height,
+                       'max_steps': max_steps // num_actors,
+                       'phi_length': phi_length,
+                       'capacity': max_steps // num_actors + margin,
+                       'storage': storage}
+        with open(os.path.join(path, 'replay.pkl'), 'wb') as handle:
+            cPickle.dump(self.header, handle, -1)
+        self.segments = [_open_segment(path, self.header, actor_id,
+                                       batch_dtype=batch_dtype)
+                         for actor_id in range(num_actors)]
+        self._batch = None
+
+    def sync(self):
+        """ Pick up the samples the actors have added. """
+        for segment in self.segments:
+            segment.sync()
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def random_batch(self, batch_size, out=None):
+        """ Return a batch of transitions drawn uniformly from the
+        phi's of all actors, in the format of DataSet.random_batch.
+        """
+        self.sync()
+        num_valid = np.array([segment._num_valid()
+                              for segment in self.segments])
+        if num_valid.sum() <= 0:
+            raise ValueError("No valid samples in the data set.")
+
+        if out is None:
+            if (self._batch is None or
+                self._batch[0].shape[0] != batch_size):
+                self._batch = self.segments[0]._empty_batch(batch_size)
+            out = self._batch
+        states, actions, rewards, terminals, next_states = out
+
+        # Every segment fills one contiguous block of rows.
+        counts = np.random.multinomial(batch_size,
+                                       num_valid / float(num_valid.sum()))
+        row = 0
+        for segment, count in zip(self.segments, counts):
+            if count == 0:
+                continue
+            rows = slice(row, row + count)
+            _gather_published(segment, count,
+                              (states[rows], actions[rows], rewards[rows],
+                               terminals[rows], next_states[rows]))
+            row += count
+        return states, actions, rewards, next_states, terminals
+
+
+def _gather_published(segment, batch_size, out):
+    """ Fill out with transitions from segment that its actor did not
+    overwrite while they were being copied.
+    """
+    while True:
+        starts = segment._random_starts(batch_size)
+        segment._gather(starts, out)
+        # The actor writes sample count % capacity before publishing
+        # count, so everything after count - capacity is intact.
+        published = int(segment._saved_count[0])
+        if np.all(starts > published - segment.capacity):
+            return
+        segment.sync()
+
+
+def attach_actor(path, actor_id=None):
+    """ Return the DataSet segment of the shared replay memory at path
+    that an actor process should add its samples to.  If actor_id is
+    None, the first unclaimed segment is claimed.
+    """
+    with open(os.path.join(path, 'replay.pkl'), 'rb') as handle:
+        header = cPickle.load(handle)
+    if actor_id is None:
+        for actor_id in range(header['num_actors']):
+            try:
+                os.mkdir(os.path.join(path, 'claimed_{}'.format(actor_id)))
+                break
+            except OSError:
+                pass
+        else:
+            raise ValueError("All segments of {} are claimed.".format(path))
+    return _open_segment(path, header, actor_id)
+
+
+def _open_segment(path, header, actor_id, batch_dtype=floatX):
+    return sumo_data_set.DataSet(
+        header['width'], header['height'],
+        max_steps=header['max_steps'],
+        phi_length=header['phi_length'],
+        capacity=header['capacity'],
+        storage=header['storage'],
+        path=os.path.join(path, 'actor_{}'.format(actor_id)),
+        batch_dtype=batch_dtype)
+
+
+# TESTING CODE BELOW THIS POINT...
+
+def _run_actor(path, num_samples):
+    np.random.seed(os.getpid() % 1000)
+    data_set = attach_actor(path)
+    img = np.zeros((data_set.height, data_set.width), dtype='uint8')
+    for i in range(num_samples):
+        # Each image holds its own index, so that a torn or mixed up
+        # transition shows in the frames.
+        img[...] = i % 256
+        data_set.add_sample(img, i % 256, i, np.random.random() < .05)
+
+
+def test_concurrent_actors():
+    import multiprocessing
+    import shutil
+    import tempfile
+    root = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm')
+                            else None)
+    path = os.path.join(root, 'replay')
+    try:
+        replay = SharedReplay(path, 3, width=6, height=5, max_steps=600,
+                              phi_length=4, margin=100)
+        actors = [multiprocessing.Process(target=_run_actor,
+                                          args=(path, 3000))
+                  for _ in range(3)]
+        for actor in actors:
+            actor.start()
+
+        num_batches = 0
+        while any(actor.is_alive() for actor in actors) or num_batches == 0:
+            try:
+                states, actions, rewards, next_states, terminals = \
+                    replay.random_batch(32)
+            except ValueError:
+                continue
+            ends = rewards[:, 0].astype('int64')
+            expected = (ends[:, np.newaxis] + np.arange(-3, 2)) % 256
+            np.testing.assert_array_equal(states[:, :, 0, 0],
+                                          expected[:, :4])
+            np.testing.assert_array_equal(next_states[:, :, 0, 0],
+                                          expected[:, 1:])
+            np.testing.assert_array_equal(actions[:, 0], ends % 256)
+            num_batches += 1
+        for actor in actors:
+            actor.join()
+            assert actor.exitcode == 0
+
+        replay.sync()
+        assert len(replay) == 3 * (200 - 4)
+        print "passed"
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    test_concurrent_actors()
+
+
+if __name__ == '__main__':
+    main()
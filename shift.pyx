@@ -2,6 +2,7 @@ from numpy cimport ndarray as ar
 import numpy as np
 cimport numpy as np
 cimport cython
+from libc.string cimport memcpy
 DTYPE = np.uint8
 
 
@@ -36,3 +37,67 @@ def shift1d_int32(ar[np.int32_t,ndim=1] data, int shift_amt):
         data[i-shift_amt] = data[i]
 
 
+ctypedef fused image_t:
+    np.uint8_t
+    np.float32_t
+    np.float64_t
+
+
+cdef inline void copy_image(const np.uint8_t *src, image_t *dst,
+                            Py_ssize_t n) nogil:
+    cdef Py_ssize_t i
+    if image_t is np.uint8_t:
+        memcpy(dst, src, n)
+    else:
+        for i in xrange(n):
+            dst[i] = <image_t> src[i]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def gather_batch(const np.uint8_t[:, :, ::1] frames,
+                 const np.int32_t[:] actions,
+                 const cython.floating[:] rewards,
+                 const np.uint8_t[:] terminal,
+                 const np.int64_t[:] starts,
+                 int n_step,
+                 image_t[:, :, :, :] states,
+                 image_t[:, :, :, :] next_states,
+                 np.int32_t[:, :] batch_actions,
+                 cython.floating[:, :] batch_rewards,
+                 np.uint8_t[:, :] batch_terminals):
+    """ Copy the transitions starting at the given logical indices from
+    the circular buffers into a batch, converting the images to the
+    batch dtype on the way.  states and next_states must be views of
+    one window of phi_length + n_step images per transition, like the
+    ones DataSet._empty_batch returns; only the images of next_states
+    after the end of states are written through next_states.  Runs
+    without the GIL.
+    """
+    cdef Py_ssize_t capacity = frames.shape[0]
+    cdef Py_ssize_t size = frames.shape[1] * frames.shape[2]
+    cdef Py_ssize_t phi_length = states.shape[1]
+    cdef Py_ssize_t first_new = max(phi_length, n_step)
+    cdef Py_ssize_t b, i, position, end
+
+    # Every image in the batch must be one contiguous block.
+    for images in (states, next_states):
+        if (images.strides[3] != sizeof(image_t) or
+            images.strides[2] != images.shape[3] * sizeof(image_t)):
+            raise ValueError("Batch images must be C-contiguous.")
+
+    with nogil:
+        for b in xrange(starts.shape[0]):
+            for i in xrange(phi_length):
+                position = (starts[b] + i) % capacity
+                copy_image(&frames[position, 0, 0], &states[b, i, 0, 0],
+                           size)
+            for i in xrange(first_new, phi_length + n_step):
+                position = (starts[b] + i) % capacity
+                copy_image(&frames[position, 0, 0],
+                           &next_states[b, i - n_step, 0, 0], size)
+            end = starts[b] + phi_length - 1
+            batch_actions[b, 0] = actions[end % capacity]
+            batch_rewards[b, 0] = rewards[end % capacity]
+            batch_terminals[b, 0] = terminal[(end + n_step) % capacity]
@@ -0,0 +1,128 @@
+"""Array-based sum tree used for prioritized experience replay.
+
+Prioritized Experience Replay
+Schaul et al., ICLR 2016
+
+The leaves hold one priority per slot and every internal node holds the
+sum of its two children, so updating a priority and drawing a slot with
+probability proportional to its priority are both O(log n).  All
+operations work on whole arrays of slots at once; updating a single
+slot, as adding a sample does, takes a scalar path.
+"""
+
+import numpy as np
+
+
+class SumTree(object):
+    """ Sum tree over a fixed number of slots, stored heap-style in one
+    array: node i has children 2i and 2i+1 and the root is node 1.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.depth = 0
+        while (1 << self.depth) < capacity:
+            self.depth += 1
+        self.num_leaves = 1 << self.depth
+        self.tree = np.zeros(2 * self.num_leaves, dtype='float64')
+
+    def total(self):
+        """ Return the sum of all priorities. """
+        return self.tree[1]
+
+    def get(self, slots):
+        """ Return the priorities of the given slots. """
+        return self.tree[np.asarray(slots) + self.num_leaves]
+
+    def update(self, slots, priorities):
+        """ Set the priorities of the given slots. """
+        nodes = np.asarray(slots, dtype='int64') + self.num_leaves
+        if nodes.size == 1:
+            if not np.isscalar(priorities):
+                priorities = np.ravel(priorities)[0]
+            self._update_one(int(nodes.flat[0]), priorities)
+            return
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def _update_one(self, node, priority):
+        """ Set the priority of one leaf node and walk up to the root.
+        The sums are recomputed rather than adjusted by the change, so
+        that they match the ones update computes for many slots.
+        """
+        tree = self.tree
+        tree[node] = priority
+        while node > 1:
+            node >>= 1
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+
+    def find(self, values):
+        """ Return, for each value in [0, total()), the slot whose
+        cumulative priority range contains it.
+        """
+        values = np.array(values, dtype='float64')
+        nodes = np.ones(len(values), dtype='int64')
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            go_right = values >= left
+            values -= np.where(go_right, left, 0.0)
+            nodes = 2 * nodes + go_right
+        slots = nodes - self.num_leaves
+        # Rounding can walk past the last nonzero leaf; step back to it.
+        empty = self.tree[nodes] <= 0
+        if np.any(empty):
+            nonzero = np.flatnonzero(self.tree[self.num_leaves:] > 0)
+            slots[empty] = nonzero[np.minimum(
+                np.searchsorted(nonzero, slots[empty]), len(nonzero) - 1)]
+        return slots
+
+    def sample(self, batch_size):
+        """ Draw batch_size slots with probability proportional to
+        their priorities, one from each of batch_size equal segments.
+        """
+        segment = self.total() / batch_size
+        values = (np.arange(batch_size) +
+                  np.random.random(batch_size)) * segment
+        return self.find(values)
+
+
+def main():
+    np.random.seed(0)
+    tree = SumTree(1000)
+    priorities = np.random.random(1000)
+    priorities[::3] = 0
+    tree.update(np.arange(1000), priorities)
+    np.testing.assert_almost_equal(tree.total(), priorities.sum())
+
+    counts = np.bincount(tree.sample(1000000), minlength=1000)
+    assert np.all(counts[::3] == 0)
+    np.testing.assert_allclose(counts / 1000000.0,
+                               priorities / priorities.sum(), atol=.001)
+    print "passed"
+
+
+def test_update_one():
+    np.random.seed(1)
+    tree1 = SumTree(37)
+    tree2 = SumTree(37)
+    for _ in range(500):
+        slot = np.random.randint(37)
+        priority = np.random.random()
+        tree1.update([slot], priority)
+        tree2.update(np.array([slot, slot]), [priority, priority])
+        np.testing.assert_array_equal(tree1.tree, tree2.tree)
+    # Many slots at once still take the array path.
+    slots = np.random.randint(37, size=10)
+    priorities = np.random.random(10)
+    tree1.update(slots, priorities)
+    for slot, priority in zip(slots, priorities):
+        tree2.update([slot], priority)
+    np.testing.assert_allclose(tree1.tree, tree2.tree)
+    print "passed"
+
+
+if __name__ == '__main__':
+    main()
+    test_update_one()
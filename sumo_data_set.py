@@ -1,24 +1,63 @@
 """This class stores all of the samples for training.  It is able to
 construct randomly selected batches of phi's from the stored history.
 
-It allocates more memory than necessary, then shifts all of the
-data back to 0 when the samples reach the end of the allocated memory.
+Samples are stored in circular buffers.  Every sample has a logical
+index (the number of samples added before it); the sample lives at
+position index % capacity, so adding a sample never moves any of
+the stored data.
+
+Frames can optionally be stored bit-packed (storage='packed'), which
+uses one bit per pixel, or as lists of occupied pixel coordinates
+(storage='sparse'), which only pays for the nonzero pixels.  Both are
+only suitable for binary images such as the SUMO occupancy grids.
+
+Given a path, the arrays are memory-mapped .npy files in that
+directory instead of living in RAM, so the history can be larger than
+physical memory and can be reopened after the process exits, or
+read by another process while it is being written (see sync()).
+
+save() and DataSet.load() write and restore a compressed snapshot of
+the history in any storage mode.
+
+With priority_alpha > 0 the data set also keeps a sum tree of
+priorities over the valid start indices for prioritized replay
+(prioritized_batch/update_priorities).
+
+Every data set also keeps a prefix count of terminal samples, so that
+checking a range of samples for a trial boundary is O(1), and a table
+of the completed episodes in the history (episodes/episode_samples).
+
+With n_step > 1 it also keeps the discounted sums of the next 1 to
+n_step rewards after every sample, so that random_batch can return
+k-step transitions (n_step=k) without summing rewards per batch.
 """
 
+import os
+import collections
+import cPickle
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import pyximport; pyximport.install(setup_args={"include_dirs":np.get_include()}, reload_support=True)
 import shift
 import time
 import theano
+from sum_tree import SumTree
 
 floatX = theano.config.floatX
 
+# Added to every |TD error| so that no transition becomes unsampleable.
+PRIORITY_EPSILON = 1e-6
+
 class DataSet(object):
     """ Class represents a data set that stores a fixed-length history.
     """
 
     def __init__(self, width, height, max_steps=1000, phi_length=4,
-                 capacity=None):
+                 capacity=None, storage='dense', path=None,
+                 priority_alpha=0, batch_dtype=floatX, n_step=1,
+                 discount=1.0):
         """  Construct a DataSet.
 
         Arguments:
@@ -26,20 +65,364 @@ class DataSet(object):
             max_steps - the length of history to store.
             phi_length - number of images to concatenate into a state.
             capacity - amount of memory to allocate (just for debugging.)
+                       Must be at least max_steps.
+            storage - 'dense' stores one byte per pixel, 'packed' stores
+                      one bit per pixel and 'sparse' stores the (row, col)
+                      coordinates of the nonzero pixels.  'packed' and
+                      'sparse' store any nonzero pixel as 1.
+            path - directory for memory-mapped storage.  If it already
+                   holds a data set with the same shape, that data set
+                   is reopened.  (Not supported for 'sparse' storage.)
+            priority_alpha - exponent applied to |TD error| to get a
+                             sampling priority.  0 disables prioritized
+                             replay.
+            batch_dtype - dtype of the images in returned batches and
+                          phi's.  'uint8' avoids the conversion to
+                          floatX and is 4x smaller.
+            n_step - longest multi-step return that random_batch can
+                     be asked for.
+            discount - discount rate for the multi-step returns.
         """
 
+        self.width = width
+        self.height = height
+        self.storage = storage
+        self.path = path
         self.count = 0
         self.max_steps = max_steps
         self.phi_length = phi_length
+        self.batch_dtype = batch_dtype
         if capacity == None:
-            self.capacity = max_steps + int(max_steps * .1)
+            self.capacity = max_steps
         else:
+            assert capacity >= max_steps, "capacity must be >= max_steps"
             self.capacity = capacity
-        self.states = np.zeros((self.capacity, height, width), dtype='uint8')
-        self.actions = np.zeros(self.capacity, dtype='int32')
-        self.rewards = np.zeros(self.capacity, dtype=floatX)
-        self.terminal = np.zeros(self.capacity, dtype='bool')
+        if path is not None:
+            if storage == 'sparse':
+                raise ValueError("Sparse storage can not be memory-mapped.")
+            if not os.path.exists(path):
+                os.makedirs(path)
+        if storage == 'dense':
+            self.states = self._allocate('states',
+                                         (self.capacity, height, width),
+                                         'uint8')
+        elif storage == 'packed':
+            self.states = self._allocate('states',
+                                         (self.capacity, height,
+                                          (width + 7) // 8),
+                                         'uint8')
+        elif storage == 'sparse':
+            # Frame i owns coords[frame_offsets[i]:+frame_lengths[i]],
+            # where offsets are logical positions in the circular
+            # coordinate pool.  The pool grows if it runs out of room.
+            self.states = None
+            self.coords = np.zeros((self.capacity * 8, 2), dtype='int16')
+            self.frame_offsets = np.zeros(self.capacity, dtype='int64')
+            self.frame_lengths = np.zeros(self.capacity, dtype='int32')
+            self._pool_top = 0
+        else:
+            raise ValueError("Unrecognized storage: {}".format(storage))
+        self.actions = self._allocate('actions', (self.capacity,), 'int32')
+        self.rewards = self._allocate('rewards', (self.capacity,), floatX)
+        self.terminal = self._allocate('terminal', (self.capacity,), 'bool')
+        if path is not None:
+            # count is written after each sample, so a reopened data
+            # set only ever sees completely stored samples.
+            self._saved_count = self._allocate('count', (1,), 'int64')
+
+        # Logical indices of every start index whose phi does not
+        # cross a trial boundary, kept as a circular queue.  Starts
+        # are appended in increasing order as samples arrive and
+        # dropped from the front once they fall out of the history.
+        self.valid_starts = np.zeros(self.capacity, dtype='int64')
+        self._valid_head = 0
+        self._valid_tail = 0
+        # Number of consecutive non-terminal samples ending at the
+        # most recent sample.
+        self._run_length = 0
+
+        # terminal_counts[i % capacity] is the number of terminal
+        # samples before sample i.
+        self.terminal_counts = np.zeros(self.capacity, dtype='int64')
+        self._num_terminals = 0
+        # Completed episodes that start within the history, as a
+        # circular queue of first sample, number of samples and sum of
+        # rewards.
+        self.episode_starts = np.zeros(self.capacity, dtype='int64')
+        self.episode_lengths = np.zeros(self.capacity, dtype='int64')
+        self.episode_returns = np.zeros(self.capacity, dtype='float64')
+        self._episode_head = 0
+        self._episode_tail = 0
+        # First sample and sum of rewards of the episode in progress.
+        self._episode_start = 0
+        self._episode_return = 0.0
+
+        self._batch = None
+        # Serializes add_sample with batches drawn on other threads.
+        self.lock = threading.Lock()
+
+        self.priority_alpha = priority_alpha
+        if priority_alpha > 0:
+            # One leaf per buffer position, holding the priority of the
+            # start index stored there (0 if it can not be sampled).
+            self.tree = SumTree(self.capacity)
+            self._max_priority = 1.0
+        else:
+            self.tree = None
+        # The newest valid start, which can be sampled once the
+        # following sample arrives.
+        self._pending_start = None
+
+        self.n_step = n_step
+        self.discount = discount
+        if n_step > 1:
+            # returns[i, k - 1] is the discounted sum of rewards i to
+            # i + k - 1.
+            self.returns = np.zeros((self.capacity, n_step), dtype=floatX)
+            # n_step_starts[k - 2] holds the starts that can be sampled
+            # as k-step transitions, as a circular queue like
+            # valid_starts.  A start is added once the sample after its
+            # k-step transition arrives.
+            self.n_step_starts = np.zeros((n_step - 1, self.capacity),
+                                          dtype='int64')
+            self._n_step_heads = np.zeros(n_step - 1, dtype='int64')
+            self._n_step_tails = np.zeros(n_step - 1, dtype='int64')
+        else:
+            self.returns = None
+
+        if path is not None:
+            self.count = int(self._saved_count[0])
+            self._rebuild_index()
+
+    def _allocate(self, name, shape, dtype):
+        """ Return a zeroed array, or a memory-mapped one if the data set
+        has a path.  Existing files are reopened.
+        """
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype)
+
+        filename = os.path.join(self.path, name + '.npy')
+        if not os.path.exists(filename):
+            return np.lib.format.open_memmap(filename, mode='w+',
+                                             dtype=dtype, shape=shape)
+        array = np.load(filename, mmap_mode='r+')
+        if array.shape != shape or array.dtype != np.dtype(dtype):
+            raise ValueError("{} does not match the data set: {} {}".format(
+                filename, array.shape, array.dtype))
+        return array
+
+    def _rebuild_index(self):
+        """ Recompute the valid start indices from the terminal flags,
+        e.g. after reopening a stored data set.
+        """
+        first = max(0, self.count - self.capacity)
+        terminal = self.terminal.take(np.arange(first, self.count),
+                                      mode='wrap')
+        # Number of terminals before each index in [first, count].
+        terminal_counts = np.concatenate(([0], np.cumsum(terminal)))
+        starts = np.arange(first, self.count - self.phi_length + 1)
+        offsets = starts - first
+        valid = (terminal_counts[offsets + self.phi_length] ==
+                 terminal_counts[offsets])
+        starts = starts[valid]
+        starts = starts[starts >= self._min_index()]
+
+        self.valid_starts[:len(starts)] = starts
+        self._valid_tail = 0
+        self._valid_head = len(starts)
+
+        self._pending_start = None
+        if len(starts) > 0 and starts[-1] > self._max_index():
+            self._pending_start = starts[-1]
+            starts = starts[:-1]
+        if self.tree is not None:
+            self.tree.update(np.arange(self.capacity), 0)
+            self.tree.update(starts % self.capacity, self._max_priority)
+
+        if self.returns is not None:
+            self._rebuild_returns(first)
+            self._rebuild_n_step_starts(first, terminal_counts)
+
+        terminal_indices = np.flatnonzero(terminal)
+        if len(terminal_indices) > 0:
+            self._run_length = len(terminal) - 1 - terminal_indices[-1]
+        else:
+            self._run_length = len(terminal)
+
+        self._rebuild_episodes(first, terminal_counts, terminal_indices)
+
+    def _rebuild_episodes(self, first, terminal_counts, terminal_indices):
+        """ Recompute the terminal counts and the episode table from the
+        samples from first on.
+        """
+        indices = np.arange(first, self.count)
+        self.terminal_counts[indices % self.capacity] = terminal_counts[:-1]
+        self._num_terminals = terminal_counts[-1]
+
+        # Sum of rewards before each index in [first, count].
+        rewards = self.rewards.take(indices, mode='wrap')
+        reward_sums = np.concatenate(([0], np.cumsum(rewards,
+                                                     dtype='float64')))
+        ends = terminal_indices + 1
+        starts = np.concatenate(([0], ends))[:-1]
+        keep = first + starts >= self._min_index()
+        if first > 0 and len(keep) > 0:
+            # The first episode may have begun before the oldest sample.
+            keep[0] = False
+        starts, ends = starts[keep], ends[keep]
+        self.episode_starts[:len(starts)] = first + starts
+        self.episode_lengths[:len(starts)] = ends - starts
+        self.episode_returns[:len(starts)] = (reward_sums[ends] -
+                                              reward_sums[starts])
+        self._episode_tail = 0
+        self._episode_head = len(starts)
+
+        if len(terminal_indices) > 0:
+            last_end = terminal_indices[-1] + 1
+        else:
+            last_end = 0
+        self._episode_start = first + last_end
+        self._episode_return = reward_sums[-1] - reward_sums[last_end]
+
+    def _rebuild_returns(self, first):
+        """ Recompute the multi-step returns of the samples from first
+        on.
+        """
+        indices = np.arange(first, self.count)
+        rewards = self.rewards.take(indices, mode='wrap')
+        num = len(indices)
+        returns = np.zeros(num)
+        for k in range(self.n_step):
+            # Add sample i + k to the returns of every sample i.
+            returns[:num - k] += self.discount ** k * rewards[k:]
+            self.returns[indices % self.capacity, k] = returns
+
+    def _rebuild_n_step_starts(self, first, terminal_counts):
+        """ Recompute the starts of the multi-step transitions from the
+        terminal counts of the samples from first on.
+        """
+        for k in range(2, self.n_step + 1):
+            # The phi and the k - 1 samples after it may not be
+            # terminal, and the sample after those must have arrived.
+            starts = np.arange(first, self.count - self.phi_length - k + 1)
+            offsets = starts - first
+            valid = (terminal_counts[offsets + self.phi_length + k - 1] ==
+                     terminal_counts[offsets])
+            starts = starts[valid]
+            starts = starts[starts >= self._min_index()]
+            self.n_step_starts[k - 2, :len(starts)] = starts
+            self._n_step_tails[k - 2] = 0
+            self._n_step_heads[k - 2] = len(starts)
+
+    def flush(self):
+        """ Write memory-mapped data to disk. """
+        if self.path is not None:
+            for array in (self.states, self.actions, self.rewards,
+                          self.terminal, self._saved_count):
+                array.flush()
+
+    def save(self, filename, chunk_size=10000, num_threads=4):
+        """ Write the stored history to filename.  The samples are
+        written as a stream of independently compressed chunks of
+        chunk_size samples, compressed by num_threads threads.
+        Priorities are not saved.
+        """
+        with self.lock:
+            first = max(0, self.count - self.capacity)
+            starts = range(first, self.count, chunk_size)
+            header = {'width': self.width,
+                      'height': self.height,
+                      'max_steps': self.max_steps,
+                      'phi_length': self.phi_length,
+                      'capacity': self.capacity,
+                      'storage': self.storage,
+                      'count': self.count,
+                      'first': first,
+                      'num_chunks': len(starts)}
+            chunks = (self._snapshot_chunk(start,
+                                           min(start + chunk_size,
+                                               self.count))
+                      for start in starts)
+            # Keep the previous snapshot intact until this one is done.
+            temp_filename = filename + '.tmp'
+            with open(temp_filename, 'wb') as handle:
+                cPickle.dump(header, handle, -1)
+                for chunk in _pipelined(_compress_chunk, chunks,
+                                        num_threads):
+                    cPickle.dump(chunk, handle, -1)
+            os.rename(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, num_threads=4, **kwargs):
+        """ Return a DataSet restored from a file written by save().
+        Chunks are decompressed by num_threads threads and copied in
+        while the following ones are still being read.  Restored
+        transitions all start at the maximum priority.
 
+        Other keyword arguments (path, priority_alpha, batch_dtype) are
+        passed to the constructor.
+        """
+        with open(filename, 'rb') as handle:
+            header = cPickle.load(handle)
+            data_set = cls(header['width'], header['height'],
+                           max_steps=header['max_steps'],
+                           phi_length=header['phi_length'],
+                           capacity=header['capacity'],
+                           storage=header['storage'], **kwargs)
+            chunks = (cPickle.load(handle)
+                      for _ in range(header['num_chunks']))
+            start = header['first']
+            for arrays in _pipelined(_decompress_chunk, chunks,
+                                     num_threads):
+                start = data_set._restore_chunk(start, arrays)
+        assert start == header['count'], "Truncated snapshot."
+
+        data_set.count = header['count']
+        if data_set.path is not None:
+            data_set._saved_count[0] = data_set.count
+        data_set._rebuild_index()
+        return data_set
+
+    def _snapshot_chunk(self, start, end):
+        """ Return copies of the arrays holding samples start to end
+        (exclusive), in order.
+        """
+        indices = np.arange(start, end)
+        if self.storage == 'sparse':
+            positions = indices % self.capacity
+            _, coords = self._frame_coords(positions)
+            frames = [self.frame_lengths[positions], coords]
+        else:
+            frames = [self.states.take(indices, axis=0, mode='wrap')]
+        return frames + [self.actions.take(indices, mode='wrap'),
+                         self.rewards.take(indices, mode='wrap'),
+                         self.terminal.take(indices, mode='wrap')]
+
+    def _restore_chunk(self, start, arrays):
+        """ Store arrays from _snapshot_chunk as the samples beginning
+        at start, and return the index after the last one.
+        """
+        if self.storage == 'sparse':
+            lengths, coords, actions, rewards, terminal = arrays
+        else:
+            frames, actions, rewards, terminal = arrays
+        positions = np.arange(start, start + len(actions)) % self.capacity
+        if self.storage == 'sparse':
+            # Restored frames are packed from the start of the pool.
+            top = self._pool_top + len(coords)
+            if top > self.coords.shape[0]:
+                self._grow_pool(0, top)
+            self.coords[self._pool_top:top] = coords
+            self.frame_offsets[positions] = (self._pool_top +
+                                             np.cumsum(lengths) - lengths)
+            self.frame_lengths[positions] = lengths
+            self._pool_top = top
+        else:
+            self.states[positions] = frames
+        self.actions[positions] = actions
+        self.rewards[positions] = rewards
+        self.terminal[positions] = terminal
+        return start + len(actions)
 
     def _min_index(self):
         return max(0, self.count - self.max_steps)
@@ -52,112 +435,483 @@ class DataSet(object):
         return max(0, (self._max_index() - self._min_index()) + 1)
 
     def add_sample(self, state, action, reward, terminal):
-        self.states[self.count, ...] = state
-        self.actions[self.count] = action
-        self.rewards[self.count] = reward
-        self.terminal[self.count] = terminal
+        with self.lock:
+            self._add_sample(state, action, reward, terminal)
+
+    def _add_sample(self, state, action, reward, terminal):
+        # Overwrites the oldest sample once the buffers are full.
+        position = self.count % self.capacity
+        self._store_frame(position, state)
+        self.actions[position] = action
+        self.rewards[position] = reward
+        self.terminal[position] = terminal
         self.count += 1
+        if self.path is not None:
+            self._saved_count[0] = self.count
+        self._index_sample(terminal)
+
+    def sync(self):
+        """ Pick up the samples that another process has added to the
+        memory-mapped arrays at path since this data set last looked.
+        """
+        with self.lock:
+            count = int(self._saved_count[0])
+            if count - self.count >= self.capacity:
+                self.count = count
+                self._rebuild_index()
+                return
+            while self.count < count:
+                self.count += 1
+                self._index_sample(
+                    self.terminal[(self.count - 1) % self.capacity])
+
+    def _index_sample(self, terminal):
+        """ Update the valid start indices (and priorities), terminal
+        counts and episodes for the sample that was just counted.
+        """
+        min_index = self._min_index()
+        self._index_episode(terminal, min_index)
+        tail = self._valid_tail
+        while (self._valid_tail < self._valid_head and
+               self.valid_starts[self._valid_tail % self.capacity] <
+               min_index):
+            self._valid_tail += 1
+
+        if self.tree is not None:
+            if self._valid_tail > tail:
+                evicted = self.valid_starts.take(
+                    np.arange(tail, self._valid_tail), mode='wrap')
+                self.tree.update(evicted % self.capacity, 0)
+            if self._pending_start is not None:
+                self.tree.update([self._pending_start % self.capacity],
+                                 self._max_priority)
+        self._pending_start = None
+
+        if self.returns is not None:
+            self._index_n_step_starts(min_index)
+
+        if terminal:
+            self._run_length = 0
+        else:
+            self._run_length += 1
+        if self._run_length >= self.phi_length:
+            start = self.count - self.phi_length
+            self.valid_starts[self._valid_head % self.capacity] = start
+            self._valid_head += 1
+            self._pending_start = start
+
+        if self.returns is not None:
+            self._index_returns()
+
+    def _index_n_step_starts(self, min_index):
+        """ Add the start of every multi-step transition that the sample
+        just counted completes, and drop the starts that left the
+        history.  Must be called before _run_length counts the sample.
+        """
+        for k in range(2, self.n_step + 1):
+            row = k - 2
+            starts = self.n_step_starts[row]
+            while (self._n_step_tails[row] < self._n_step_heads[row] and
+                   starts[self._n_step_tails[row] % self.capacity] <
+                   min_index):
+                self._n_step_tails[row] += 1
+            # The samples before this one are not terminal back to the
+            # start of the phi.
+            start = self.count - self.phi_length - k
+            if (self._run_length >= self.phi_length + k - 1 and
+                start >= min_index):
+                starts[self._n_step_heads[row] % self.capacity] = start
+                self._n_step_heads[row] += 1
+
+    def _index_episode(self, terminal, min_index):
+        index = self.count - 1
+        position = index % self.capacity
+        self.terminal_counts[position] = self._num_terminals
+        self._episode_return += self.rewards[position]
+
+        while (self._episode_tail < self._episode_head and
+               self.episode_starts[self._episode_tail % self.capacity] <
+               min_index):
+            self._episode_tail += 1
+        if terminal:
+            self._num_terminals += 1
+            if self._episode_start >= min_index:
+                slot = self._episode_head % self.capacity
+                self.episode_starts[slot] = self._episode_start
+                self.episode_lengths[slot] = index + 1 - self._episode_start
+                self.episode_returns[slot] = self._episode_return
+                self._episode_head += 1
+            self._episode_start = index + 1
+            self._episode_return = 0.0
+
+    def _index_returns(self):
+        """ Add the most recent sample to the multi-step returns of the
+        samples before it.
+        """
+        index = self.count - 1
+        position = index % self.capacity
+        self.returns[position] = 0
+        ends = np.arange(max(0, index - self.n_step + 1,
+                             index - self.capacity + 1), index + 1)
+        steps = index - ends
+        positions = ends % self.capacity
+        # The sample is reward number steps + 1 of each of their returns.
+        self.returns[positions] += (
+            self.rewards[position] * self.discount ** steps[:, np.newaxis] *
+            (np.arange(self.n_step) >= steps[:, np.newaxis]))
+
+    def _store_frame(self, position, state):
+        if self.storage == 'packed':
+            self.states[position, ...] = np.packbits(
+                np.asarray(state, dtype='uint8'), axis=-1)
+        elif self.storage == 'sparse':
+            rows, cols = np.nonzero(state)
+            # Everything older than the frame being overwritten is dead.
+            oldest = max(0, self.count + 1 - self.capacity)
+            if oldest < self.count:
+                live_start = self.frame_offsets[oldest % self.capacity]
+            else:
+                live_start = self._pool_top
+            needed = self._pool_top + len(rows) - live_start
+            if needed > self.coords.shape[0]:
+                self._grow_pool(live_start, needed)
+            pool_indices = (np.arange(self._pool_top,
+                                      self._pool_top + len(rows)) %
+                            self.coords.shape[0])
+            self.coords[pool_indices, 0] = rows
+            self.coords[pool_indices, 1] = cols
+            self.frame_offsets[position] = self._pool_top
+            self.frame_lengths[position] = len(rows)
+            self._pool_top += len(rows)
+        else:
+            self.states[position, ...] = state
+
+    def _grow_pool(self, live_start, needed):
+        """ Reallocate the coordinate pool so that it holds at least
+        needed coordinates, keeping the live ones.
+        """
+        size = max(2 * self.coords.shape[0], needed)
+        live = np.arange(live_start, self._pool_top)
+        coords = np.zeros((size, 2), dtype='int16')
+        coords[live % size] = self.coords[live % self.coords.shape[0]]
+        self.coords = coords
+
+    def _frame_coords(self, positions):
+        """ Return the frame each coordinate belongs to and the
+        coordinates of the sparse frames at the given buffer positions,
+        concatenated in order.
+        """
+        lengths = self.frame_lengths[positions]
+        offsets = self.frame_offsets[positions]
+        frame_ids = np.repeat(np.arange(len(positions)), lengths)
+        # Position of every coordinate within its own frame.
+        within = (np.arange(lengths.sum()) -
+                  np.repeat(np.cumsum(lengths) - lengths, lengths))
+        coords = self.coords[(offsets[frame_ids] + within) %
+                             self.coords.shape[0]]
+        return frame_ids, coords
 
-        # Shift the final max_steps back to the beginning.
-        if self.count == self.capacity:
-            roll_amount = self.capacity - self.max_steps
-            shift.shift3d_uint8(self.states, roll_amount)
-            self.actions = np.roll(self.actions, -roll_amount)
-            self.rewards = np.roll(self.rewards, -roll_amount)
-            self.terminal = np.roll(self.terminal, -roll_amount)
-            self.count = self.max_steps
+    def _frames(self, indices, out=None):
+        """ Return the images stored at the given logical indices, with
+        shape indices.shape + (height, width).  The images are written
+        to out if it is given, otherwise a new uint8 array is returned.
+        """
+        indices = np.asarray(indices)
+        if out is None:
+            out = np.empty(indices.shape + (self.height, self.width),
+                           dtype='uint8')
+        if self.storage == 'sparse':
+            frame_ids, coords = self._frame_coords(
+                indices.ravel() % self.capacity)
+            out.fill(0)
+            out[np.unravel_index(frame_ids, indices.shape) +
+                (coords[:, 0], coords[:, 1])] = 1
+        elif self.storage == 'packed':
+            frames = self.states.take(indices, axis=0, mode='wrap')
+            out[...] = np.unpackbits(frames, axis=-1)[..., :self.width]
+        else:
+            out[...] = self.states.take(indices, axis=0, mode='wrap')
+        return out
 
     def no_terminal(self, start, end):
         """ Make sure that a possible phi does not cross a trial boundary.
         """
         # start and end are inclusive
-        return np.alltrue(np.logical_not(self.terminal[start:end+1]))
+        return (self._terminals_before(end + 1) ==
+                self._terminals_before(start))
+
+    def _terminals_before(self, indices):
+        """ Return the number of terminal samples before each index. """
+        indices = np.asarray(indices)
+        return np.where(indices >= self.count, self._num_terminals,
+                        self.terminal_counts[indices % self.capacity])
+
+    def episodes(self):
+        """ Return the first samples, numbers of samples and sums of
+        rewards of the completed episodes that start within the
+        history, oldest first.
+        """
+        with self.lock:
+            slots = (np.arange(self._episode_tail, self._episode_head) %
+                     self.capacity)
+            return (self.episode_starts[slots], self.episode_lengths[slots],
+                    self.episode_returns[slots])
+
+    def episode_samples(self, start, length):
+        """ Return the images, actions, rewards and terminal flags of
+        length samples from start, e.g. of an episode from episodes().
+        """
+        indices = np.arange(start, start + length)
+        return (self._frames(indices),
+                self.actions.take(indices, mode='wrap'),
+                self.rewards.take(indices, mode='wrap'),
+                self.terminal.take(indices, mode='wrap'))
 
     def last_phi(self):
         """
         Return the most recent phi.
         """
         phi = self._make_phi(self.count - self.phi_length)
-        return  np.array(phi, dtype=floatX)
+        return  np.array(phi, dtype=self.batch_dtype)
 
     def phi(self, state):
         """
         Return a phi based on the latest image, by grabbing enough
         history from the data set to fill it out.
         """
-        phi = np.empty((self.phi_length,
-                        self.states.shape[1],
-                        self.states.shape[2]),
-                       dtype=floatX)
+        phi = np.empty((self.phi_length, self.height, self.width),
+                       dtype=self.batch_dtype)
 
         phi[0:(self.phi_length-1), ...] = self.last_phi()[1::]
         phi[self.phi_length-1, ...] = state
         return phi
 
     def _make_phi(self, index):
-        end_index = index + self.phi_length - 1
-        #assert self.no_terminal(index, end_index)
-        return self.states[index:end_index + 1, ...]
-
-    def _empty_batch(self, batch_size):
-        # Set aside memory for the batch
-        states = np.empty((batch_size, self.phi_length,
-                           self.states.shape[1], self.states.shape[2]),
-                          dtype=floatX)
+        #assert self.no_terminal(index, index + self.phi_length - 1)
+        return self._frames(np.arange(index, index + self.phi_length))
+
+    def _empty_batch(self, batch_size, n_step=1):
+        # Set aside memory for the batch.  Phi's n_step apart share all
+        # but n_step images, so states and next_states are the first
+        # and last phi_length images of one window of
+        # phi_length + n_step.
+        windows = np.empty((batch_size, self.phi_length + n_step,
+                            self.height, self.width), dtype=self.batch_dtype)
+        states = windows[:, :self.phi_length]
         actions = np.empty((batch_size, 1), dtype='int32')
         rewards = np.empty((batch_size, 1), dtype=floatX)
         terminals = np.empty((batch_size, 1), dtype=bool)
 
-        next_states = np.empty((batch_size, self.phi_length,
-                                self.states.shape[1],
-                                self.states.shape[2]), dtype=floatX)
+        next_states = windows[:, n_step:]
         return states, actions, rewards, terminals, next_states
 
     def batch_iterator(self, batch_size):
-        """ Generator for iterating over all valid batches. """
-        index = self._min_index()
-        batch_count = 0
-        states, actions, rewards, terminals, next_states = \
-                self._empty_batch(batch_size)      
-        while index <= self._max_index():
-            end_index = index + self.phi_length - 1
-            if self.no_terminal(index, end_index):
-                states[batch_count, ...] = self._make_phi(index)
-                actions[batch_count, 0] = self.actions[end_index]
-                rewards[batch_count, 0] = self.rewards[end_index]
-                terminals[batch_count, 0] = self.terminal[end_index+1]
-                next_states[batch_count, ...] = self._make_phi(index+1)
-                batch_count += 1
-            index += 1
-
-            if batch_count == batch_size:
-                yield states, actions, rewards, terminals, next_states
-                batch_count = 0
-                states, actions, rewards, terminals, next_states = \
-                    self._empty_batch(batch_size)      
-
-                
-    def random_batch(self, batch_size):
-
-        count = 0
-        states, actions, rewards, terminals, next_states = \
-            self._empty_batch(batch_size)
-
-        # Grab random samples until we have enough
-        while count < batch_size:
-            index = np.random.randint(self._min_index(), self._max_index()+1)
-            end_index = index + self.phi_length - 1
-            if self.no_terminal(index, end_index):
-                states[count, ...] = self._make_phi(index)
-                actions[count, 0] = self.actions[end_index]
-                rewards[count, 0] = self.rewards[end_index]
-                terminals[count, 0] = self.terminal[end_index+1]
-                next_states[count, ...] = self._make_phi(index+1)
-                count += 1
+        """ Generator for iterating over all valid batches.  Every
+        batch is written to the same buffers, so it is only valid until
+        the next one is requested.
+        """
+        with self.lock:
+            num_valid = self._num_valid()
+            starts = self.valid_starts.take(
+                np.arange(self._valid_tail, self._valid_tail + num_valid),
+                mode='wrap')
+        batch = self._empty_batch(batch_size)
+        for first in range(0, num_valid - batch_size + 1, batch_size):
+            states, actions, rewards, next_states, terminals = \
+                self._gather(starts[first:first + batch_size], batch)
+            yield states, actions, rewards, terminals, next_states
+
+    def _num_valid(self):
+        """ Return the number of valid start indices that can be sampled.
+        """
+        num = self._valid_head - self._valid_tail
+        # The newest start has no next state yet.
+        if (num > 0 and
+            self.valid_starts[(self._valid_head - 1) % self.capacity] >
+            self._max_index()):
+            num -= 1
+        return num
+
+    def random_batch(self, batch_size, out=None, n_step=1):
+        """ Return a batch of transitions drawn uniformly from all
+        phi's that do not cross a trial boundary.
+
+        With n_step > 1, every transition spans n_step steps: rewards
+        are the discounted sums of n_step rewards and next_states are
+        the phi's n_step samples later.  The trial may not end within
+        those steps.  n_step can be at most the data set's n_step.
+
+        states and next_states are views into a single window of
+        phi_length + n_step images per transition.
+
+        The batch is written to out, a tuple from _empty_batch, if it
+        is given.  Otherwise the returned arrays are reused by the next
+        call with the same batch size; copy them if they must outlive
+        it.
+        """
+        if n_step > self.n_step:
+            raise ValueError("n_step must be at most {}.".format(self.n_step))
+        with self.lock:
+            return self._gather(self._random_starts(batch_size, n_step),
+                                out, n_step)
+
+    def random_transitions(self, batch_size, n_step=1):
+        """ Draw transitions like random_batch, but return the start
+        indices of their phi's instead of the images, for a network
+        that keeps its own copy of the frames.
+
+        Returns: starts, actions, rewards, terminals
+        """
+        if n_step > self.n_step:
+            raise ValueError("n_step must be at most {}.".format(self.n_step))
+        with self.lock:
+            starts = self._random_starts(batch_size, n_step)
+            end_indices = starts + (self.phi_length - 1)
+            actions = self.actions.take(end_indices, mode='wrap')
+            rewards = self._returns(n_step).take(end_indices, mode='wrap')
+            terminals = self.terminal.take(end_indices + n_step, mode='wrap')
+        return (starts, actions.reshape((-1, 1)),
+                rewards.reshape((-1, 1)), terminals.reshape((-1, 1)))
+
+    def _returns(self, n_step):
+        """ Return the array of n_step rewards ending at every sample. """
+        if n_step > 1:
+            return self.returns[:, n_step - 1]
+        return self.rewards
+
+    def _random_starts(self, batch_size, n_step=1):
+        """ Draw batch_size start indices uniformly from the ones that
+        can be sampled as n_step transitions.
+        """
+        if n_step > 1:
+            queue = self.n_step_starts[n_step - 2]
+            tail = self._n_step_tails[n_step - 2]
+            num_valid = self._n_step_heads[n_step - 2] - tail
+            if num_valid <= 0:
+                raise ValueError("No valid {}-step samples in the data "
+                                 "set.".format(n_step))
+        else:
+            queue = self.valid_starts
+            tail = self._valid_tail
+            num_valid = self._num_valid()
+            if num_valid <= 0:
+                raise ValueError("No valid samples in the data set.")
+
+        draws = np.random.randint(num_valid, size=batch_size)
+        return queue[(draws + tail) % self.capacity]
+
+    def prioritized_batch(self, batch_size, beta, out=None):
+        """ Return a batch of transitions drawn with probability
+        proportional to their priorities, followed by their start
+        indices (for update_priorities) and importance-sampling
+        weights normalized so that the largest one is 1.
+
+        out is used like in random_batch.
+        """
+        if self.tree is None:
+            raise ValueError("The data set is not prioritized.")
+        with self.lock:
+            num_valid = self._num_valid()
+            if num_valid <= 0:
+                raise ValueError("No valid samples in the data set.")
+
+            slots = self.tree.sample(batch_size)
+            # Every sampleable start lies in the max_steps indices
+            # ending at _max_index(), so its buffer position
+            # identifies it.
+            max_index = self._max_index()
+            indices = max_index - (max_index - slots) % self.capacity
+
+            probabilities = self.tree.get(slots) / self.tree.total()
+            weights = (num_valid * probabilities) ** -beta
+            weights = (weights / weights.max()).astype(floatX)
+
+            batch = self._gather(indices, out)
+            return batch + (indices, weights.reshape((-1, 1)))
+
+    def update_priorities(self, indices, td_errors):
+        """ Set the priorities of the transitions starting at the given
+        indices from their TD errors.
+        """
+        indices = np.asarray(indices, dtype='int64')
+        if len(indices) == 0:
+            return
+        priorities = ((np.abs(np.ravel(td_errors)) + PRIORITY_EPSILON) **
+                      self.priority_alpha)
+        with self.lock:
+            # Skip transitions that left the history since they were
+            # drawn.
+            live = indices >= self._min_index()
+            self.tree.update(indices[live] % self.capacity,
+                             priorities[live])
+            self._max_priority = max(self._max_priority, priorities.max())
+
+    def _gather(self, indices, out=None, n_step=1):
+        """ Build a batch from the phi's starting at the given indices.
+        """
+        batch_size = len(indices)
+        if out is None:
+            if (self._batch is None or
+                self._batch[0].shape[0] != batch_size or
+                self._batch[4].base.shape[1] != self.phi_length + n_step):
+                self._batch = self._empty_batch(batch_size, n_step)
+            out = self._batch
+        states, actions, rewards, terminals, next_states = out
+
+        returns = self._returns(n_step)
+        if self.storage == 'dense':
+            # One pass over the batch, without the GIL.
+            shift.gather_batch(self.states, self.actions, returns,
+                               self.terminal.view('uint8'),
+                               np.asarray(indices, dtype='int64'), n_step,
+                               states, next_states, actions, rewards,
+                               terminals.view('uint8'))
+            return states, actions, rewards, next_states, terminals
+
+        # Filling states and the images of next_states after them
+        # fills the whole window.
+        phi_indices = indices[:, np.newaxis] + np.arange(self.phi_length)
+        self._frames(phi_indices, out=states)
+        first_new = max(self.phi_length, n_step)
+        new_indices = (indices[:, np.newaxis] +
+                       np.arange(first_new, self.phi_length + n_step))
+        self._frames(new_indices, out=next_states[:, first_new - n_step:])
+        end_indices = indices + (self.phi_length - 1)
+        actions[:, 0] = self.actions.take(end_indices, mode='wrap')
+        rewards[:, 0] = returns.take(end_indices, mode='wrap')
+        terminals[:, 0] = self.terminal.take(end_indices + n_step,
+                                             mode='wrap')
 
         return states, actions, rewards, next_states, terminals
 
 
+def _compress_chunk(arrays):
+    return [(array.dtype.str, array.shape, zlib.compress(array, 1))
+            for array in arrays]
+
+
+def _decompress_chunk(chunk):
+    return [np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+            for dtype, shape, data in chunk]
+
+
+def _pipelined(function, items, num_threads):
+    """ Yield function(item) for every item, in order, computed by
+    num_threads threads.  Only a few items are in flight at a time, so
+    items can be produced and results consumed as a stream.
+    """
+    pool = ThreadPool(num_threads)
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) >= 2 * num_threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
 
 # TESTING CODE BELOW THIS POINT...
 
@@ -256,6 +1010,74 @@ def test_iterator():
         print "s ", s, "a ",a, "r ",r,"t ", t,"ns ", ns
 
 
+def test_batch_iterator():
+    dataset = DataSet(width=3, height=4, max_steps=50, phi_length=4,
+                      capacity=57)
+    for i in range(130):
+        img = np.random.randint(0, 256, size=(4, 3))
+        dataset.add_sample(img, i, i, np.random.random() < .1)
+
+    # Every index that starts a phi within one trial, in order.
+    expected = [index for index in range(dataset._min_index(),
+                                         dataset._max_index() + 1)
+                if dataset.no_terminal(index, index + 3)]
+    batches = 0
+    for states, actions, rewards, terminals, next_states in \
+            dataset.batch_iterator(5):
+        for j in range(5):
+            index = expected[5 * batches + j]
+            assert actions[j, 0] == index + 3
+            np.testing.assert_array_equal(states[j],
+                                          dataset._make_phi(index))
+            np.testing.assert_array_equal(next_states[j],
+                                          dataset._make_phi(index + 1))
+            assert terminals[j, 0] == dataset.terminal[(index + 4) % 57]
+        batches += 1
+    assert batches == len(expected) // 5
+    print "passed"
+
+
+def test_episodes():
+    dataset = DataSet(width=3, height=4, max_steps=50, phi_length=4,
+                      capacity=57)
+    terminals = []
+    rewards = []
+    for i in range(300):
+        img = np.random.randint(0, 256, size=(4, 3))
+        terminal = np.random.random() < .1 or i % 20 == 19
+        dataset.add_sample(img, i, i, terminal)
+        terminals.append(terminal)
+        rewards.append(i)
+
+        for start in range(dataset._min_index(), dataset.count - 4):
+            assert (dataset.no_terminal(start, start + 3) ==
+                    (not any(terminals[start:start + 4])))
+
+        # Every completed episode that starts within the history.
+        ends = [index for index in range(i + 1) if terminals[index]]
+        expected = [(start, end - start + 1, sum(rewards[start:end + 1]))
+                    for start, end in zip([0] + [end + 1 for end in ends],
+                                          ends)
+                    if start >= dataset._min_index()]
+        starts, lengths, returns = dataset.episodes()
+        assert zip(starts, lengths, returns) == expected
+
+    # The table rebuilt from the stored samples matches.
+    dataset._rebuild_index()
+    assert zip(*dataset.episodes()) == expected
+    for index in range(dataset._min_index(), dataset.count - 4):
+        assert (dataset.no_terminal(index, index + 3) ==
+                (not any(terminals[index:index + 4])))
+
+    start, length, _ = expected[-1]
+    images, actions, rewards, terminal = dataset.episode_samples(start,
+                                                                 length)
+    np.testing.assert_array_equal(actions, np.arange(start, start + length))
+    assert terminal[-1] and not np.any(terminal[:-1])
+    np.testing.assert_array_equal(images[0], dataset._make_phi(start)[0])
+    print "passed"
+
+
 def test_random_batch():
     dataset1 = DataSet(width=3, height=4, max_steps=50, phi_length=4)
     dataset2 = DataSet(width=3, height=4, max_steps=50, phi_length=4,
@@ -299,6 +1121,235 @@ def test_random_batch():
             np.random.seed(hash(time.time()))
 
 
+def test_valid_starts():
+    dataset = DataSet(width=3, height=2, max_steps=20, phi_length=4,
+                      capacity=23)
+    for i in range(200):
+        img = np.random.randint(0, 256, size=(2, 3))
+        terminal = np.random.random() < .2
+        dataset.add_sample(img, 1, 1, terminal)
+        expected = [index for index in range(dataset._min_index(),
+                                             dataset._max_index() + 1)
+                    if dataset.no_terminal(index,
+                                           index + dataset.phi_length - 1)]
+        starts = [dataset.valid_starts[(dataset._valid_tail + i) %
+                                       dataset.capacity]
+                  for i in range(dataset._num_valid())]
+        assert starts == expected
+    print "passed"
+
+
+def test_packed_storage():
+    dataset1 = DataSet(width=11, height=4, max_steps=50, phi_length=4)
+    dataset2 = DataSet(width=11, height=4, max_steps=50, phi_length=4,
+                       storage='packed')
+    assert dataset2.states.nbytes * 5 < dataset1.states.nbytes
+
+    for i in range(200):
+        img = np.random.randint(0, 2, size=(4, 11))
+        terminal = np.random.random() < .05
+        dataset1.add_sample(img, 1, 1, terminal)
+        dataset2.add_sample(img, 1, 1, terminal)
+        np.testing.assert_array_equal(dataset1.phi(img), dataset2.phi(img))
+        if i > 10:
+            np.random.seed(i)
+            batch1 = dataset1.random_batch(10)
+            np.random.seed(i)
+            batch2 = dataset2.random_batch(10)
+            for array1, array2 in zip(batch1, batch2):
+                np.testing.assert_array_equal(array1, array2)
+    print "passed"
+
+
+def test_sparse_storage():
+    dataset1 = DataSet(width=20, height=16, max_steps=50, phi_length=4,
+                       capacity=53)
+    dataset2 = DataSet(width=20, height=16, max_steps=50, phi_length=4,
+                       capacity=53, storage='sparse')
+
+    for i in range(500):
+        # Vary the density so that the coordinate pool has to grow.
+        img = np.random.random((16, 20)) < (i / 1000.0)
+        terminal = np.random.random() < .05
+        dataset1.add_sample(img, 1, 1, terminal)
+        dataset2.add_sample(img, 1, 1, terminal)
+        np.testing.assert_array_equal(dataset1.phi(img), dataset2.phi(img))
+        if i > 10:
+            np.random.seed(i)
+            batch1 = dataset1.random_batch(10)
+            np.random.seed(i)
+            batch2 = dataset2.random_batch(10)
+            for array1, array2 in zip(batch1, batch2):
+                np.testing.assert_array_equal(array1, array2)
+    print "passed"
+
+
+def test_memmap_storage():
+    import shutil
+    import tempfile
+    path = tempfile.mkdtemp()
+    try:
+        dataset1 = DataSet(width=3, height=4, max_steps=50, phi_length=4)
+        dataset2 = DataSet(width=3, height=4, max_steps=50, phi_length=4,
+                           path=path)
+        for i in range(120):
+            img = np.random.randint(0, 256, size=(4, 3))
+            terminal = np.random.random() < .05
+            dataset1.add_sample(img, i, i, terminal)
+            dataset2.add_sample(img, i, i, terminal)
+        dataset2.flush()
+        del dataset2
+
+        # Reopen the stored data set.
+        dataset2 = DataSet(width=3, height=4, max_steps=50, phi_length=4,
+                           path=path)
+        assert dataset2.count == dataset1.count
+        np.random.seed(1)
+        batch1 = dataset1.random_batch(10)
+        np.random.seed(1)
+        batch2 = dataset2.random_batch(10)
+        for array1, array2 in zip(batch1, batch2):
+            np.testing.assert_array_equal(array1, array2)
+        print "passed"
+    finally:
+        shutil.rmtree(path)
+
+
+def test_prioritized_batch():
+    dataset = DataSet(width=3, height=4, max_steps=50, phi_length=4,
+                      capacity=57, priority_alpha=1)
+    for i in range(300):
+        img = np.random.randint(0, 256, size=(4, 3))
+        dataset.add_sample(img, 1, i, np.random.random() < .05)
+        if i > 10:
+            states, actions, rewards, next_states, terminals, indices, \
+                weights = dataset.prioritized_batch(10, .5)
+            assert np.all(indices >= dataset._min_index())
+            assert np.all(indices <= dataset._max_index())
+            for j, index in enumerate(indices):
+                assert dataset.no_terminal(index, index + 3)
+                np.testing.assert_array_equal(states[j],
+                                              dataset._make_phi(index))
+            assert np.all(weights <= 1)
+
+            # Only the most recent transitions keep a high priority.
+            dataset.update_priorities(indices, np.zeros(10))
+            recent = [index for index in range(dataset._max_index() - 5,
+                                               dataset._max_index() + 1)
+                      if dataset.no_terminal(index, index + 3)]
+            dataset.update_priorities(recent, 1000 * np.ones(len(recent)))
+    indices = dataset.prioritized_batch(1000, .5)[5]
+    assert np.mean(indices >= dataset._max_index() - 5) > .9
+    print "passed"
+
+
+def test_save_load():
+    import shutil
+    import tempfile
+    path = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(path, 'replay.pkl')
+        for storage in ('dense', 'packed', 'sparse'):
+            dataset1 = DataSet(width=20, height=16, max_steps=50,
+                               phi_length=4, capacity=53, storage=storage)
+            for i in range(170):
+                img = np.random.random((16, 20)) < .2
+                terminal = np.random.random() < .05
+                dataset1.add_sample(img, i, i, terminal)
+            dataset1.save(filename, chunk_size=7, num_threads=2)
+            dataset2 = DataSet.load(filename, num_threads=2)
+
+            assert dataset2.count == dataset1.count
+            assert len(dataset2) == len(dataset1)
+            np.testing.assert_array_equal(dataset1.last_phi(),
+                                          dataset2.last_phi())
+            np.random.seed(1)
+            batch1 = dataset1.random_batch(10)
+            np.random.seed(1)
+            batch2 = dataset2.random_batch(10)
+            for array1, array2 in zip(batch1, batch2):
+                np.testing.assert_array_equal(array1, array2)
+            print "passed"
+    finally:
+        shutil.rmtree(path)
+
+
+def test_n_step_batch():
+    np.random.seed(12)
+    dataset = DataSet(width=3, height=4, max_steps=50, phi_length=4,
+                      capacity=57, n_step=3, discount=.9)
+    for i in range(300):
+        img = np.random.randint(0, 256, size=(4, 3))
+        dataset.add_sample(img, i, np.random.random(),
+                           np.random.random() < .05)
+        if i < 20:
+            continue
+        for n_step in (1, 3):
+            states, actions, rewards, next_states, terminals = \
+                dataset.random_batch(10, n_step=n_step)
+            for j in range(10):
+                end = actions[j, 0]
+                index = end - 3
+                assert index >= dataset._min_index()
+                assert dataset.no_terminal(index, end + n_step - 1)
+                np.testing.assert_array_equal(states[j],
+                                              dataset._make_phi(index))
+                np.testing.assert_array_equal(
+                    next_states[j], dataset._make_phi(index + n_step))
+                expected = sum(.9 ** k * dataset.rewards[(end + k) % 57]
+                               for k in range(n_step))
+                np.testing.assert_allclose(rewards[j, 0], expected,
+                                           rtol=1e-5)
+
+    # The incremental returns and starts match the ones rebuilt from
+    # scratch.
+    returns = dataset.returns.copy()
+    starts = [_n_step_starts(dataset, n_step) for n_step in (2, 3)]
+    dataset._rebuild_index()
+    np.testing.assert_allclose(dataset.returns, returns, rtol=1e-5)
+    assert [_n_step_starts(dataset, n_step) for n_step in (2, 3)] == starts
+    print "passed"
+
+
+def _n_step_starts(dataset, n_step):
+    row = n_step - 2
+    return [dataset.n_step_starts[row, index % dataset.capacity]
+            for index in range(dataset._n_step_tails[row],
+                               dataset._n_step_heads[row])]
+
+
+def test_n_step_starts():
+    dataset = DataSet(width=3, height=2, max_steps=40, phi_length=4,
+                      capacity=43, n_step=3)
+    for i in range(300):
+        img = np.random.randint(0, 256, size=(2, 3))
+        dataset.add_sample(img, 1, 1, np.random.random() < .15)
+        for n_step in (2, 3):
+            expected = [index for index in range(dataset._min_index(),
+                                                 dataset.count - 3 - n_step)
+                        if dataset.no_terminal(index, index + 2 + n_step)]
+            assert _n_step_starts(dataset, n_step) == expected
+
+    # Episodes of five samples only have one-step transitions, except
+    # for a single longer one that has the only 3-step transitions.
+    dataset = DataSet(width=3, height=2, max_steps=1000, phi_length=4,
+                      n_step=3)
+    for i in range(990):
+        img = np.random.randint(0, 256, size=(2, 3))
+        dataset.add_sample(img, i, 1, i % 5 == 4 and i != 504)
+    assert dataset._num_valid() > 40 * len(_n_step_starts(dataset, 3))
+    assert _n_step_starts(dataset, 3) == [500, 501, 502, 503]
+    for _ in range(10):
+        states, actions, rewards, next_states, terminals = \
+            dataset.random_batch(32, n_step=3)
+        for j in range(32):
+            index = actions[j, 0] - 3
+            assert 500 <= index <= 503
+            np.testing.assert_array_equal(next_states[j],
+                                          dataset._make_phi(index + 3))
+    print "passed"
+
+
 def test_memory_usage_ok():
     import memory_profiler
     dataset = DataSet(width=80, height=80, max_steps=100000, phi_length=4)
@@ -325,6 +1376,16 @@ def main():
     #max_size_tests()
     #simple_tests()
     #test_iterator()
+    #test_batch_iterator()
+    #test_episodes()
+    #test_valid_starts()
+    #test_packed_storage()
+    #test_sparse_storage()
+    #test_memmap_storage()
+    #test_prioritized_batch()
+    #test_save_load()
+    #test_n_step_batch()
+    #test_n_step_starts()
 
 if __name__ == "__main__":
     main()